@@ -0,0 +1,80 @@
+"""比较微信读书接口响应的几种JSON解析方式的耗时
+
+用法：
+    python scripts/benchmark_json.py [响应文件]
+
+响应文件是用浏览器或者curl保存下来的接口原始响应，例如
+https://i.weread.qq.com/book/bookmarklist?bookId=xxx 返回的内容，
+没有指定时使用固定随机种子生成的划线列表，结果可以重复，但是和真实数据有差别
+"""
+
+import argparse
+import json
+import random
+import timeit
+
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def make_payload(count=5000, seed=0):
+    """生成和bookmarklist结构类似的数据"""
+    rng = random.Random(seed)
+    text = "微信读书划线内容示例"
+    updated = [
+        {
+            "bookId": "123456",
+            "bookVersion": 1,
+            "bookmarkId": f"123456_{i}_{rng.randint(0, 10000)}-{rng.randint(0, 10000)}",
+            "chapterUid": rng.randint(1, 100),
+            "colorStyle": rng.randint(0, 5),
+            "createTime": 1700000000 + i,
+            "markText": text * rng.randint(1, 20),
+            "range": f"{rng.randint(0, 10000)}-{rng.randint(0, 10000)}",
+            "style": rng.randint(0, 2),
+            "type": 1,
+        }
+        for i in range(count)
+    ]
+    return json.dumps({"synckey": 1700000000, "updated": updated}).encode("utf-8")
+
+
+def make_response(content):
+    response = requests.Response()
+    response.status_code = 200
+    response._content = content
+    return response
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs="?", help="保存下来的接口响应")
+    parser.add_argument("-n", "--number", type=int, default=20)
+    options = parser.parse_args()
+    if options.path:
+        with open(options.path, "rb") as f:
+            content = f.read()
+    else:
+        content = make_payload()
+    print(f"响应大小：{len(content) / 1024 / 1024:.2f}MB")
+    cases = {
+        "r.json()": lambda: make_response(content).json(),
+        "json.loads(r.content)": lambda: json.loads(make_response(content).content),
+    }
+    if orjson is not None:
+        cases["orjson.loads(r.content)"] = lambda: orjson.loads(
+            make_response(content).content
+        )
+    else:
+        print("没有安装orjson，跳过")
+    for name, func in cases.items():
+        seconds = min(timeit.repeat(func, number=options.number, repeat=3))
+        print(f"{name}: {seconds / options.number * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,15 @@
 import argparse
+import asyncio
 from datetime import datetime, timedelta
 import os
+import sys
 
 import pendulum
 import requests
-from notion_helper import NotionHelper
+from notion_client.errors import APIResponseError
+from notion_helper import NotionHelper, RELATION_PRELOAD_THRESHOLD
 
-from weread_api import WeReadApi
+from weread_api import AsyncWeReadApi, WeReadApi, WeReadAuthError
 import utils
 from config import book_properties_type_dict, tz
 from retrying import retry
@@ -48,10 +51,10 @@ def insert_book_to_notion(books, index, bookId):
         book["书架分类"] = archive_dict.get(bookId)
     if bookId in notion_books:
         book.update(notion_books.get(bookId))
-    bookInfo = weread_api.get_bookinfo(bookId)
+    bookInfo = book_infos.get(bookId)
     if bookInfo is not None:
         book.update(bookInfo)
-    readInfo = weread_api.get_read_info(bookId)
+    readInfo = read_infos.get(bookId)
     readInfo.update(readInfo.get("readDetail", {}))
     readInfo.update(readInfo.get("bookInfo", {}))
     book.update(readInfo)
@@ -120,11 +123,17 @@ def insert_book_to_notion(books, index, bookId):
     parent = {"database_id": notion_helper.book_database_id, "type": "database_id"}
     result = None
     if bookId in notion_books:
-        result = notion_helper.update_page(
-            page_id=notion_books.get(bookId).get("pageId"),
-            properties=properties,
-            cover=utils.get_icon(cover),
-        )
+        page_id = notion_books.get(bookId).get("pageId")
+        try:
+            result = notion_helper.update_page(
+                page_id=page_id,
+                properties=properties,
+                cover=utils.get_icon(cover),
+            )
+        except APIResponseError as e:
+            if notion_helper.handle_dead_book_page(bookId, page_id, e):
+                return
+            raise
     else:
         result = notion_helper.create_book_page(
             parent=parent,
@@ -138,10 +147,56 @@ def insert_book_to_notion(books, index, bookId):
         insert_read_data(page_id, data)
 
 
+def need_fresh_bookinfo(bookId, readInfo):
+    """新书和已读完的书需要请求最新的书籍详情，缓存中没有评分"""
+    if bookId not in notion_books:
+        return True
+    if isinstance(readInfo, BaseException):
+        return False
+    merged = dict(readInfo)
+    merged.update(readInfo.get("readDetail", {}))
+    merged.update(readInfo.get("bookInfo", {}))
+    return merged.get("markedStatus") == 4
+
+
+async def prefetch_books(bookIds):
+    """并发获取书籍详情和阅读信息，单本书失败时结果中是对应的异常
+
+    先获取阅读信息，根据阅读状态决定书籍详情是否可以用缓存
+    """
+    async_api = AsyncWeReadApi(weread_api)
+    readInfos = await async_api.gather(
+        async_api.get_read_info, bookIds, return_exceptions=True
+    )
+    bookInfos = await async_api.gather(
+        lambda bookId: async_api.get_bookinfo(
+            bookId, need_fresh_bookinfo(bookId, readInfos.get(bookId))
+        ),
+        bookIds,
+        return_exceptions=True,
+    )
+    return bookInfos, readInfos
+
+
+def drop_failed_books(books):
+    """去掉预先获取失败的书，登录失效时直接抛出，其他的错误跳过这本书"""
+    failed = set()
+    for results in (book_infos, read_infos):
+        for bookId, result in results.items():
+            if isinstance(result, WeReadAuthError):
+                raise result
+            if isinstance(result, BaseException):
+                print(f"::warning::获取{bookId}的信息失败，跳过这本书：{result}")
+                failed.add(bookId)
+    return [bookId for bookId in books if bookId not in failed]
+
+
 def insert_read_data(page_id, readTimes):
     readTimes = dict(sorted(readTimes.items()))
     filter = {"property": "书架", "relation": {"contains": page_id}}
-    results = notion_helper.query_all_by_book(notion_helper.read_database_id, filter)
+    results = notion_helper.query_all_by_book(
+        notion_helper.read_database_id, filter, filter_properties=["时间戳", "时长"]
+    )
     for result in results:
         timestamp = result.get("properties").get("时间戳").get("number")
         duration = result.get("properties").get("时长").get("number")
@@ -188,62 +243,74 @@ if __name__ == "__main__":
     weread_api = WeReadApi()
     notion_helper = NotionHelper()
     notion_books = notion_helper.get_all_book()
-    bookshelf_books = weread_api.get_bookshelf()
+    try:
+        bookshelf_books = weread_api.get_bookshelf()
 
-    # 打印获取到的书架数据
-    print("Bookshelf Books:", bookshelf_books)
+        # 打印获取到的书架数据
+        print("Bookshelf Books:", bookshelf_books)
 
-    # 获取名为 "ll的书架" 的书籍
-    ll_bookshelf = next((shelf for shelf in bookshelf_books.get("archive", []) if shelf.get("name") == "ll的书架"), None)
+        # 获取名为 "ll的书架" 的书籍
+        ll_bookshelf = next((shelf for shelf in bookshelf_books.get("archive", []) if shelf.get("name") == "ll的书架"), None)
 
-    if ll_bookshelf:
-        print("Selected Bookshelf:", ll_bookshelf)  # 打印选中的书架信息
+        if ll_bookshelf:
+            print("Selected Bookshelf:", ll_bookshelf)  # 打印选中的书架信息
 
-        bookProgress = ll_bookshelf.get("bookProgress", [])
-        bookProgress = {book.get("bookId"): book for book in bookProgress}
-        archive_dict = {bookId: ll_bookshelf.get("name") for bookId in ll_bookshelf.get("bookIds", [])}
-    else:
-        bookProgress = {}
-        archive_dict = {}
-
-    print("Book Progress:", bookProgress)
-    print("Archive Dict:", archive_dict)
-
-    # 获取 "ll的书架" 中不需要同步的书籍
-    not_need_sync = []
-    for key, value in notion_books.items():
-        if (
-            (key not in bookProgress or value.get("readingTime") == bookProgress.get(key, {}).get("readingTime"))
-            and (archive_dict.get(key) == value.get("category"))
-            and (value.get("cover") is not None)
-            and (
-                value.get("status") != "已读"
-                or (value.get("status") == "已读" and value.get("myRating"))
+            bookProgress = ll_bookshelf.get("bookProgress", [])
+            bookProgress = {book.get("bookId"): book for book in bookProgress}
+            archive_dict = {bookId: ll_bookshelf.get("name") for bookId in ll_bookshelf.get("bookIds", [])}
+        else:
+            bookProgress = {}
+            archive_dict = {}
+
+        print("Book Progress:", bookProgress)
+        print("Archive Dict:", archive_dict)
+
+        # 获取 "ll的书架" 中不需要同步的书籍
+        not_need_sync = []
+        for key, value in notion_books.items():
+            if (
+                (key not in bookProgress or value.get("readingTime") == bookProgress.get(key, {}).get("readingTime"))
+                and (archive_dict.get(key) == value.get("category"))
+                and (value.get("cover") is not None)
+                and (
+                    value.get("status") != "已读"
+                    or (value.get("status") == "已读" and value.get("myRating"))
+                )
+            ):
+                not_need_sync.append(key)
+
+        # 获取 "ll的书架" 中的书籍
+        ll_bookshelf_books = set(ll_bookshelf.get("bookIds", []))
+        # 提取 "ll的书架" 中的书籍，并去重
+        # 获取所有笔记本中的书籍列表
+        notebooks = weread_api.get_notebooklist()
+        # 仅同步 "ll的书架" 中的书籍
+        books = list(ll_bookshelf_books - set(not_need_sync))
+        # 检查重复情况
+        # 打印书架中的所有书籍
+        print("All Books in 'll的书架':", ll_bookshelf_books)
+        print(f"去重后的书籍数量: {len(books)}")
+        print("Books to Sync:", books)
+        print("Notion Books:", notion_books)
+        print("Book Progress:", bookProgress)
+        for key, value in notion_books.items():
+            print(f"Checking book {key}:")
+            print(f"  Reading Time: {value.get('readingTime')} == {bookProgress.get(key, {}).get('readingTime')}")
+            print(f"  Archive Dict Category: {archive_dict.get(key)} == {value.get('category')}")
+            print(f"  Cover: {value.get('cover')}")
+            print(f"  Status: {value.get('status')} and My Rating: {value.get('myRating')}")
+
+        if len(books) >= RELATION_PRELOAD_THRESHOLD:
+            notion_helper.preload_relations(
+                [notion_helper.author_database_id, notion_helper.category_database_id]
             )
-        ):
-            not_need_sync.append(key)
-
-    # 获取 "ll的书架" 中的书籍
-    ll_bookshelf_books = set(ll_bookshelf.get("bookIds", []))
-    # 提取 "ll的书架" 中的书籍，并去重
-    # 获取所有笔记本中的书籍列表
-    notebooks = weread_api.get_notebooklist()
-    # 仅同步 "ll的书架" 中的书籍
-    books = list(ll_bookshelf_books - set(not_need_sync))
-    # 检查重复情况
-    # 打印书架中的所有书籍
-    print("All Books in 'll的书架':", ll_bookshelf_books)
-    print(f"去重后的书籍数量: {len(books)}")
-    print("Books to Sync:", books)
-    print("Notion Books:", notion_books)
-    print("Book Progress:", bookProgress)
-    for key, value in notion_books.items():
-        print(f"Checking book {key}:")
-        print(f"  Reading Time: {value.get('readingTime')} == {bookProgress.get(key, {}).get('readingTime')}")
-        print(f"  Archive Dict Category: {archive_dict.get(key)} == {value.get('category')}")
-        print(f"  Cover: {value.get('cover')}")
-        print(f"  Status: {value.get('status')} and My Rating: {value.get('myRating')}")
-
-    # 插入书籍到 Notion
-    for index, bookId in enumerate(books):
-        insert_book_to_notion(books, index, bookId)
+            notion_helper.preload_date_relations()
+        book_infos, read_infos = asyncio.run(prefetch_books(books))
+        books = drop_failed_books(books)
+        # 插入书籍到 Notion
+        for index, bookId in enumerate(books):
+            insert_book_to_notion(books, index, bookId)
+    except WeReadAuthError as e:
+        # Cookie失效时熔断，直接结束本次同步
+        print(f"::error::{e}")
+        sys.exit(1)
@@ -1,12 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import logging
 import os
 import re
+import threading
 import time
+from urllib.parse import unquote
 
+import httpx
 from notion_client import Client
-from retrying import retry
+from notion_client.errors import APIErrorCode, APIResponseError
 from datetime import timedelta
 from dotenv import load_dotenv
+from rate_limiter import ThrottledTransport, notion_bucket
+from retry_policy import retry
+from state import load_state, save_state
+from store import RelationStore
 from utils import (
     format_date,
     get_date,
@@ -27,6 +37,31 @@ TAG_ICON_URL = "https://www.notion.so/icons/tag_gray.svg"
 USER_ICON_URL = "https://www.notion.so/icons/user-circle-filled_gray.svg"
 TARGET_ICON_URL = "https://www.notion.so/icons/target_red.svg"
 BOOKMARK_ICON_URL = "https://www.notion.so/icons/bookmark_gray.svg"
+HEATMAP_URL = "https://heatmap.malinkang.com/"
+# 查找数据库时并发请求子块的数量
+CRAWL_WORKERS = int(os.getenv("NOTION_CRAWL_WORKERS", 3))
+# 书架数据库必须包含的属性和类型
+BOOK_DATABASE_PROPERTIES = {
+    "阅读时长": "number",
+    "书架分类": "select",
+    "豆瓣链接": "url",
+    "我的评分": "select",
+    "豆瓣短评": "rich_text",
+    # NeoDB先不添加了，现在受众还不广，可能有的小伙伴不知道是干什么的
+    # "NeoDB链接": "url",
+}
+# 书架数据库结构校验结果的有效期
+SCHEMA_CACHE_TTL = int(os.getenv("NOTION_SCHEMA_CACHE_TTL", 24 * 3600))
+# 需要同步的数量超过这个值时，先把关联数据库整个读下来，避免逐个查询
+RELATION_PRELOAD_THRESHOLD = int(os.getenv("NOTION_RELATION_PRELOAD_THRESHOLD", 20))
+# 书架索引全量刷新的间隔，期间只增量获取修改过的书，全量刷新用来发现删除的书
+BOOK_INDEX_FULL_SYNC_INTERVAL = int(
+    os.getenv("NOTION_BOOK_INDEX_FULL_SYNC_INTERVAL", 7 * 24 * 3600)
+)
+# 并发写入数据库行的线程数，实际速率由rate_limiter控制
+NOTION_WORKERS = int(os.getenv("NOTION_WORKERS", 3))
+# 是否用SQLite在多次运行之间保存关联页面的ID
+RELATION_STORE = os.getenv("NOTION_RELATION_STORE", "1") not in ("0", "false", "False")
 
 
 class NotionHelper:
@@ -47,13 +82,44 @@ class NotionHelper:
     heatmap_block_id = None
 
     def __init__(self):
-        self.client = Client(auth=os.getenv("NOTION_TOKEN"), log_level=logging.ERROR)
+        self.client = Client(
+            auth=os.getenv("NOTION_TOKEN"),
+            log_level=logging.ERROR,
+            client=httpx.Client(transport=ThrottledTransport(notion_bucket)),
+        )
         self.__cache = {}
+        self.preloaded_database_ids = set()
+        self.relation_store = RelationStore() if RELATION_STORE else None
+        # 从SQLite中读到的页面ID，写入失败时用来校验和重新获取
+        self.stored_relations = {}
+        self.relation_locks = {}
+        self.property_ids = load_state("notion_property_ids.json")
+        self.property_ids_lock = threading.Lock()
+        self.relation_locks_lock = threading.Lock()
         self.page_id = self.extract_page_id(os.getenv("NOTION_PAGE"))
-        self.search_database(self.page_id)
         for key in self.database_name_dict.keys():
             if os.getenv(key) != None and os.getenv(key) != "":
                 self.database_name_dict[key] = os.getenv(key)
+        from_cache = self.load_database_ids()
+        if not from_cache:
+            self.search_database(self.page_id)
+            self.save_database_ids()
+        self.init_database_ids()
+        try:
+            self.update_book_database()
+        except APIResponseError as e:
+            # 缓存的数据库ID已经失效，重新查找一次
+            if not from_cache or e.code != APIErrorCode.ObjectNotFound:
+                raise
+            self.database_id_dict.clear()
+            self.search_database(self.page_id)
+            self.save_database_ids()
+            self.init_database_ids()
+            self.update_book_database()
+        if self.read_database_id is None:
+            self.create_database()
+
+    def init_database_ids(self):
         self.book_database_id = self.database_id_dict.get(
             self.database_name_dict.get("BOOK_DATABASE_NAME")
         )
@@ -87,9 +153,6 @@ class NotionHelper:
         self.read_database_id = self.database_id_dict.get(
             self.database_name_dict.get("READ_DATABASE_NAME")
         )
-        self.update_book_database()
-        if self.read_database_id is None:
-            self.create_database()
 
     def extract_page_id(self, notion_url):
         # 正则表达式匹配 32 个字符的 Notion page_id
@@ -102,58 +165,117 @@ class NotionHelper:
         else:
             raise Exception(f"获取NotionID失败，请检查输入的Url是否正确")
 
+    def load_database_ids(self):
+        """读取上次保存的数据库ID，所有数据库都能找到时才使用"""
+        state = load_state("notion_databases.json").get(self.page_id, {})
+        database_id_dict = state.get("database_id_dict", {})
+        names = self.database_name_dict.values()
+        if not all(name in database_id_dict for name in names):
+            return False
+        self.database_id_dict.update(database_id_dict)
+        self.heatmap_block_id = state.get("heatmap_block_id")
+        return True
+
+    def save_database_ids(self):
+        state = load_state("notion_databases.json")
+        state[self.page_id] = {
+            "database_id_dict": self.database_id_dict,
+            "heatmap_block_id": self.heatmap_block_id,
+        }
+        save_state("notion_databases.json", state)
+
+    def forget_database_ids(self):
+        """数据库ID失效时删除缓存，下次启动时重新查找和校验"""
+        state = load_state("notion_databases.json")
+        state.pop(self.page_id, None)
+        save_state("notion_databases.json", state)
+        state = load_state("notion_schema.json")
+        state.pop(self.book_database_id, None)
+        save_state("notion_schema.json", state)
+
     def search_database(self, block_id):
-        children = self.client.blocks.children.list(block_id=block_id)["results"]
-        # 遍历子块
-        for child in children:
-            # 检查子块的类型
-            if child["type"] == "child_database":
-                self.database_id_dict[child.get("child_database").get("title")] = (
-                    child.get("id")
-                )
-            elif child["type"] == "embed" and child.get("embed").get("url"):
-                if child.get("embed").get("url").startswith("https://heatmap.malinkang.com/"):
-                    self.heatmap_block_id = child.get("id")
-            # 如果子块有子块，递归调用函数
-            if "has_children" in child and child["has_children"]:
-                self.search_database(child["id"])
-
-    def update_book_database(self):
-        """更新数据库"""
+        """广度优先并发遍历子块，所有数据库和热力图都找到后就停止"""
+        names = set(self.database_name_dict.values())
+        block_ids = [block_id]
+        with ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as executor:
+            while block_ids:
+                next_block_ids = []
+                for children in executor.map(self.get_all_block_children, block_ids):
+                    for child in children:
+                        if child["type"] == "child_database":
+                            title = child.get("child_database").get("title")
+                            self.database_id_dict.setdefault(title, child.get("id"))
+                        elif child["type"] == "embed" and child.get("embed").get("url"):
+                            if child.get("embed").get("url").startswith(HEATMAP_URL):
+                                self.heatmap_block_id = child.get("id")
+                        if child.get("has_children"):
+                            next_block_ids.append(child["id"])
+                if names.issubset(self.database_id_dict) and self.heatmap_block_id:
+                    break
+                block_ids = next_block_ids
+
+    def search_heatmap(self):
+        """热力图是后添加的时候缓存里没有，重新查找一次"""
+        if self.heatmap_block_id is None:
+            self.search_database(self.page_id)
+            self.save_database_ids()
+        return self.heatmap_block_id
+
+    @retry()
+    def get_all_block_children(self, block_id):
+        """获取所有子块，处理分页"""
+        results = []
+        start_cursor = None
+        while True:
+            response = self.client.blocks.children.list(
+                block_id=block_id, start_cursor=start_cursor, page_size=100
+            )
+            results.extend(response.get("results"))
+            if not response.get("has_more"):
+                return results
+            start_cursor = response.get("next_cursor")
+
+    def get_schema_fingerprint(self):
+        content = json.dumps(
+            [self.book_database_id, BOOK_DATABASE_PROPERTIES], sort_keys=True
+        )
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def update_book_database(self, force=False):
+        """更新数据库，结构校验过并且没有过期时跳过"""
+        fingerprint = self.get_schema_fingerprint()
+        state = load_state("notion_schema.json")
+        cached = state.get(self.book_database_id, {})
+        if (
+            not force
+            and cached.get("fingerprint") == fingerprint
+            and time.time() - cached.get("verified_at", 0) < SCHEMA_CACHE_TTL
+        ):
+            return
         response = self.client.databases.retrieve(database_id=self.book_database_id)
         id = response.get("id")
         properties = response.get("properties")
         update_properties = {}
-        if (
-            properties.get("阅读时长") is None
-            or properties.get("阅读时长").get("type") != "number"
-        ):
-            update_properties["阅读时长"] = {"number": {}}
-        if (
-            properties.get("书架分类") is None
-            or properties.get("书架分类").get("type") != "select"
-        ):
-            update_properties["书架分类"] = {"select": {}}
-        if (
-            properties.get("豆瓣链接") is None
-            or properties.get("豆瓣链接").get("type") != "url"
-        ):
-            update_properties["豆瓣链接"] = {"url": {}}
-        if (
-            properties.get("我的评分") is None
-            or properties.get("我的评分").get("type") != "select"
-        ):
-            update_properties["我的评分"] = {"select": {}}
-        if (
-            properties.get("豆瓣短评") is None
-            or properties.get("豆瓣短评").get("type") != "rich_text"
-        ):
-            update_properties["豆瓣短评"] = {"rich_text": {}}
-        """NeoDB先不添加了，现在受众还不广，可能有的小伙伴不知道是干什么的"""
-        # if properties.get("NeoDB链接") is None or properties.get("NeoDB链接").get("type") != "url":
-        #     update_properties["NeoDB链接"] = {"url": {}}
+        for name, type in BOOK_DATABASE_PROPERTIES.items():
+            if properties.get(name) is None or properties.get(name).get("type") != type:
+                update_properties[name] = {type: {}}
         if len(update_properties) > 0:
             self.client.databases.update(database_id=id, properties=update_properties)
+        state[self.book_database_id] = {
+            "fingerprint": fingerprint,
+            "verified_at": time.time(),
+        }
+        save_state("notion_schema.json", state)
+
+    def write_book_page(self, func, **kwargs):
+        """写入书架时属性校验失败，说明数据库结构变了，重新校验后再写一次"""
+        try:
+            return self.write_page(func, **kwargs)
+        except APIResponseError as e:
+            if e.code != APIErrorCode.ValidationError:
+                raise
+            self.update_book_database(force=True)
+            return self.write_page(func, **kwargs)
 
     def create_database(self):
         title = [
@@ -183,6 +305,10 @@ class NotionHelper:
             icon=get_icon("https://www.notion.so/icons/target_gray.svg"),
             properties=properties,
         ).get("id")
+        self.database_id_dict[
+            self.database_name_dict.get("READ_DATABASE_NAME")
+        ] = self.read_database_id
+        self.save_database_ids()
 
     def update_heatmap(self, block_id, url):
         # 更新 image block 的链接
@@ -241,22 +367,110 @@ class NotionHelper:
             day, self.day_database_id, TARGET_ICON_URL, properties
         )
 
+    def preload_relations(self, database_ids):
+        """分页读取整个关联数据库，建立标题到页面ID的索引"""
+        for id in database_ids:
+            if id is None or id in self.preloaded_database_ids:
+                continue
+            rows = []
+            for result in self.query_all(id, filter_properties=["标题"]):
+                title = result.get("properties").get("标题").get("title")
+                name = "".join([x.get("plain_text") for x in title])
+                self.__cache.setdefault(f"{id}{name}", result.get("id"))
+                rows.append((id, name, self.__cache.get(f"{id}{name}")))
+            if self.relation_store:
+                self.relation_store.set_many(rows)
+            self.preloaded_database_ids.add(id)
+
+    def preload_date_relations(self):
+        self.preload_relations(
+            [
+                self.year_database_id,
+                self.month_database_id,
+                self.week_database_id,
+                self.day_database_id,
+            ]
+        )
+
     def get_relation_id(self, name, id, icon, properties={}):
         key = f"{id}{name}"
         if key in self.__cache:
             return self.__cache.get(key)
-        filter = {"property": "标题", "title": {"equals": name}}
-        response = self.client.databases.query(database_id=id, filter=filter)
-        if len(response.get("results")) == 0:
-            parent = {"database_id": id, "type": "database_id"}
-            properties["标题"] = get_title(name)
-            page_id = self.client.pages.create(
-                parent=parent, properties=properties, icon=get_icon(icon)
-            ).get("id")
-        else:
-            page_id = response.get("results")[0].get("id")
-        self.__cache[key] = page_id
-        return page_id
+        # 多个线程同时获取同一个标题时只创建一次页面
+        with self.get_relation_lock(key):
+            if key in self.__cache:
+                return self.__cache.get(key)
+            if self.relation_store:
+                page_id = self.relation_store.get(id, name)
+                if page_id:
+                    self.stored_relations[page_id] = (name, id, icon, properties)
+                    self.__cache[key] = page_id
+                    return page_id
+            # 已经预加载过的数据库中没有的话说明不存在，不需要再查询
+            results = []
+            if id not in self.preloaded_database_ids:
+                filter = {"property": "标题", "title": {"equals": name}}
+                response = self.client.databases.query(database_id=id, filter=filter)
+                results = response.get("results")
+            if len(results) == 0:
+                parent = {"database_id": id, "type": "database_id"}
+                properties["标题"] = get_title(name)
+                page_id = self.write_page(
+                    self.client.pages.create,
+                    parent=parent,
+                    properties=properties,
+                    icon=get_icon(icon),
+                ).get("id")
+            else:
+                page_id = results[0].get("id")
+            self.__cache[key] = page_id
+            if self.relation_store:
+                self.relation_store.set(id, name, page_id)
+            return page_id
+
+    def get_relation_lock(self, key):
+        with self.relation_locks_lock:
+            if key not in self.relation_locks:
+                self.relation_locks[key] = threading.RLock()
+            return self.relation_locks[key]
+
+    def is_page_alive(self, page_id):
+        try:
+            page = self.client.pages.retrieve(page_id=page_id)
+        except APIResponseError as e:
+            if e.code == APIErrorCode.ObjectNotFound:
+                return False
+            raise
+        return not page.get("archived") and not page.get("in_trash")
+
+    def replace_stale_relations(self, properties):
+        """把属性中已经被删除或者归档的关联页面替换成重新获取的页面"""
+        replaced = False
+        for property in (properties or {}).values():
+            for relation in property.get("relation", []):
+                page_id = relation.get("id")
+                if page_id not in self.stored_relations or self.is_page_alive(page_id):
+                    continue
+                name, id, icon, relation_properties = self.stored_relations.pop(page_id)
+                self.relation_store.delete(page_id)
+                self.__cache.pop(f"{id}{name}", None)
+                relation["id"] = self.get_relation_id(
+                    name, id, icon, relation_properties
+                )
+                replaced = True
+        return replaced
+
+    def write_page(self, func, **kwargs):
+        """写入失败时检查用到的关联页面是否还存在，替换失效的页面后再写一次"""
+        try:
+            return func(**kwargs)
+        except APIResponseError as e:
+            if e.code not in (
+                APIErrorCode.ValidationError,
+                APIErrorCode.ObjectNotFound,
+            ) or not self.replace_stale_relations(kwargs.get("properties")):
+                raise
+            return func(**kwargs)
 
     def insert_bookmark(self, id, bookmark):
         icon = get_icon(BOOKMARK_ICON_URL)
@@ -278,10 +492,9 @@ class NotionHelper:
             properties["Date"] = get_date(create_time.strftime("%Y-%m-%d %H:%M:%S"))
             self.get_date_relation(properties, create_time)
         parent = {"database_id": self.bookmark_database_id, "type": "database_id"}
-        self.create_page(parent, properties, icon)
+        return self.create_page(parent, properties, icon)
 
     def insert_review(self, id, review):
-        time.sleep(0.1)
         icon = get_icon(TAG_ICON_URL)
         properties = {
             "Name": get_title(review.get("content", "")),
@@ -304,10 +517,9 @@ class NotionHelper:
             properties["Date"] = get_date(create_time.strftime("%Y-%m-%d %H:%M:%S"))
             self.get_date_relation(properties, create_time)
         parent = {"database_id": self.review_database_id, "type": "database_id"}
-        self.create_page(parent, properties, icon)
+        return self.create_page(parent, properties, icon)
 
     def insert_chapter(self, id, chapter):
-        time.sleep(0.1)
         icon = {"type": "external", "external": {"url": TAG_ICON_URL}}
         properties = {
             "Name": get_title(chapter.get("title")),
@@ -320,58 +532,129 @@ class NotionHelper:
             "书籍": {"relation": [{"id": id}]},
         }
         parent = {"database_id": self.chapter_database_id, "type": "database_id"}
-        self.create_page(parent, properties, icon)
+        return self.create_page(parent, properties, icon)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    def update_bookmark(self, page_id, bookmark):
+        """更新划线中可能在微信读书中修改的属性"""
+        properties = {
+            "Name": get_title(bookmark.get("markText", "")),
+            "colorStyle": get_number(bookmark.get("colorStyle")),
+            "style": get_number(bookmark.get("style")),
+        }
+        return self.update_note_page(page_id, properties)
+
+    def update_review(self, page_id, review):
+        """更新笔记中可能在微信读书中修改的属性"""
+        abstract = review.get("abstract")
+        properties = {
+            "Name": get_title(review.get("content", "")),
+            "abstract": get_rich_text(abstract) if abstract else {"rich_text": []},
+        }
+        return self.update_note_page(page_id, properties)
+
+    @retry()
+    def update_note_page(self, page_id, properties):
+        return self.write_page(
+            self.client.pages.update, page_id=page_id, properties=properties
+        )
+
+    @retry()
     def update_book_page(self, page_id, properties):
-        return self.client.pages.update(page_id=page_id, properties=properties)
+        return self.write_book_page(
+            self.client.pages.update, page_id=page_id, properties=properties
+        )
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @retry()
     def update_page(self, page_id, properties, cover):
-        return self.client.pages.update(
-            page_id=page_id, properties=properties, cover=cover
+        return self.write_book_page(
+            self.client.pages.update,
+            page_id=page_id,
+            properties=properties,
+            cover=cover,
         )
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @retry()
     def create_page(self, parent, properties, icon):
-        return self.client.pages.create(parent=parent, properties=properties, icon=icon)
+        return self.write_page(
+            self.client.pages.create, parent=parent, properties=properties, icon=icon
+        )
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @retry()
     def create_book_page(self, parent, properties, icon):
-        return self.client.pages.create(
-            parent=parent, properties=properties, icon=icon, cover=icon
+        return self.write_book_page(
+            self.client.pages.create,
+            parent=parent,
+            properties=properties,
+            icon=icon,
+            cover=icon,
         )
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @retry()
     def query(self, **kwargs):
         kwargs = {k: v for k, v in kwargs.items() if v}
-        return self.client.databases.query(**kwargs)
+        return self.query_database(**kwargs)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @retry()
     def get_block_children(self, id):
         response = self.client.blocks.children.list(id)
         return response.get("results")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @retry()
     def append_blocks(self, block_id, children):
         return self.client.blocks.children.append(block_id=block_id, children=children)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @retry()
     def append_blocks_after(self, block_id, children, after):
         return self.client.blocks.children.append(
             block_id=block_id, children=children, after=after
         )
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @retry()
+    def update_block(self, block_id, block):
+        """用get_callout等函数生成的块的内容更新已有的块"""
+        type = block.get("type")
+        return self.client.blocks.update(block_id=block_id, **{type: block.get(type)})
+
+    @retry()
     def delete_block(self, block_id):
         return self.client.blocks.delete(block_id=block_id)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def get_all_book(self):
-        """从Notion中获取所有的书籍"""
-        results = self.query_all(self.book_database_id)
-        books_dict = {}
+        """从Notion中获取所有的书籍
+
+        本地保存上次的结果和最大的last_edited_time，之后只查询这之后修改过的书，
+        每隔BOOK_INDEX_FULL_SYNC_INTERVAL全量刷新一次
+        """
+        state = load_state("notion_books.json")
+        snapshot = state.get(self.book_database_id, {})
+        high_water = snapshot.get("high_water")
+        full_sync_at = snapshot.get("full_sync_at", 0)
+        filter = None
+        if high_water and time.time() - full_sync_at < BOOK_INDEX_FULL_SYNC_INTERVAL:
+            books_dict = snapshot.get("books", {})
+            filter = {
+                "timestamp": "last_edited_time",
+                "last_edited_time": {"on_or_after": high_water},
+            }
+        else:
+            books_dict = {}
+            full_sync_at = time.time()
+        results = self.iter_query(
+            self.book_database_id,
+            filter=filter,
+            filter_properties=[
+                "BookId",
+                "阅读时长",
+                "书架分类",
+                "Sort",
+                "豆瓣链接",
+                "我的评分",
+                "豆瓣短评",
+                "阅读状态",
+            ],
+        )
         for result in results:
+            high_water = max(high_water or "", result.get("last_edited_time"))
             bookId = get_property_value(result.get("properties").get("BookId"))
             books_dict[bookId] = {
                 "pageId": result.get("id"),
@@ -392,41 +675,96 @@ class NotionHelper:
                 "comment": get_property_value(result.get("properties").get("豆瓣短评")),
                 "status": get_property_value(result.get("properties").get("阅读状态")),
             }
+        state[self.book_database_id] = {
+            "high_water": high_water,
+            "full_sync_at": full_sync_at,
+            "books": books_dict,
+        }
+        save_state("notion_books.json", state)
         return books_dict
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def query_all_by_book(self, database_id, filter):
-        results = []
-        has_more = True
-        start_cursor = None
-        while has_more:
-            response = self.client.databases.query(
-                database_id=database_id,
-                filter=filter,
-                start_cursor=start_cursor,
-                page_size=100,
+    def forget_book(self, bookId):
+        """从本地的书架索引中删除这本书，并让下次运行时全量刷新索引"""
+        state = load_state("notion_books.json")
+        snapshot = state.get(self.book_database_id)
+        if snapshot:
+            snapshot.get("books", {}).pop(bookId, None)
+            snapshot["full_sync_at"] = 0
+            save_state("notion_books.json", state)
+
+    def handle_dead_book_page(self, bookId, page_id, e):
+        """写入书籍页面失败时检查页面是否已经被删除或者放入回收站
+
+        索引在两次全量刷新之间会保留已经删除的页面，这时从索引中去掉这本书，
+        下次运行时全量刷新后重新创建，返回True；页面正常时返回False，由调用方抛出异常
+        """
+        if not isinstance(e, APIResponseError) or e.code not in (
+            APIErrorCode.ObjectNotFound,
+            APIErrorCode.ValidationError,
+        ):
+            return False
+        if self.is_page_alive(page_id):
+            return False
+        self.forget_book(bookId)
+        print(f"::warning::书籍页面{page_id}已经被删除，下次运行时重新同步{bookId}")
+        return True
+
+    def get_property_ids(self, database_id, names):
+        """把属性名转换成filter_properties需要的属性ID"""
+        with self.property_ids_lock:
+            ids = self.property_ids.get(database_id)
+            if ids is None or any(name not in ids for name in names):
+                response = self.client.databases.retrieve(database_id=database_id)
+                ids = {
+                    name: unquote(property.get("id"))
+                    for name, property in response.get("properties").items()
+                }
+                self.property_ids[database_id] = ids
+                save_state("notion_property_ids.json", self.property_ids)
+        return [ids.get(name) for name in names if name in ids]
+
+    def query_database(self, filter_properties=None, **kwargs):
+        """查询数据库，filter_properties是属性名列表，只返回这些属性"""
+        database_id = kwargs.get("database_id")
+        if filter_properties:
+            kwargs["filter_properties"] = self.get_property_ids(
+                database_id, filter_properties
             )
-            start_cursor = response.get("next_cursor")
-            has_more = response.get("has_more")
-            results.extend(response.get("results"))
-        return results
+        try:
+            return self.client.databases.query(**kwargs)
+        except APIResponseError as e:
+            if e.code == APIErrorCode.ObjectNotFound:
+                self.forget_database_ids()
+            if e.code != APIErrorCode.ValidationError or not filter_properties:
+                raise
+            # 属性ID可能已经变化，不使用投影再查询一次
+            with self.property_ids_lock:
+                self.property_ids.pop(database_id, None)
+            kwargs.pop("filter_properties")
+            return self.client.databases.query(**kwargs)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def query_all(self, database_id):
-        """获取database中所有的数据"""
-        results = []
-        has_more = True
+    def iter_query(self, database_id, filter=None, filter_properties=None):
+        """逐页返回数据库中的数据，每一页单独重试，失败时从上一页的next_cursor继续"""
         start_cursor = None
-        while has_more:
-            response = self.client.databases.query(
+        while True:
+            response = self.query(
                 database_id=database_id,
+                filter=filter,
+                filter_properties=filter_properties,
                 start_cursor=start_cursor,
                 page_size=100,
             )
+            yield from response.get("results")
+            if not response.get("has_more"):
+                return
             start_cursor = response.get("next_cursor")
-            has_more = response.get("has_more")
-            results.extend(response.get("results"))
-        return results
+
+    def query_all_by_book(self, database_id, filter, filter_properties=None):
+        return list(self.iter_query(database_id, filter, filter_properties))
+
+    def query_all(self, database_id, filter_properties=None):
+        """获取database中所有的数据，filter_properties指定只返回哪些属性"""
+        return list(self.iter_query(database_id, filter_properties=filter_properties))
 
     def get_date_relation(self, properties, date):
         properties["年"] = get_relation(
@@ -448,4 +786,59 @@ class NotionHelper:
             [
                 self.get_day_relation_id(date),
             ]
-        )
\ No newline at end of file
+        )
+
+
+class DeletionQueue:
+    """收集一本书中需要删除的块和数据库行，统一并发删除
+
+    add的一组ID全部删除成功才算这一组删除成功，并发请求的速率由rate_limiter控制，
+    删除失败的ID在最后再统一重试一次，可以在多个线程中同时add
+    """
+
+    def __init__(self, notion_helper, workers=NOTION_WORKERS):
+        self.notion_helper = notion_helper
+        self.workers = workers
+        self.groups = []
+        self.lock = threading.Lock()
+
+    def add(self, *ids):
+        group = [id for id in ids if id]
+        if group:
+            with self.lock:
+                self.groups.append(group)
+
+    def delete(self, id):
+        try:
+            self.notion_helper.delete_block(id)
+        except APIResponseError as e:
+            # 已经被删除的不算失败
+            if e.code != APIErrorCode.ObjectNotFound:
+                raise
+
+    def delete_all(self, ids):
+        """并发删除，返回删除失败的ID和对应的错误"""
+        failures = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for id, future in [(id, executor.submit(self.delete, id)) for id in ids]:
+                try:
+                    future.result()
+                except Exception as e:
+                    failures[id] = e
+        return failures
+
+    def flush(self):
+        """删除所有收集到的ID，返回全部删除成功的组"""
+        with self.lock:
+            groups, self.groups = self.groups, []
+        ids = list(dict.fromkeys(id for group in groups for id in group))
+        if not ids:
+            return groups
+        print(f"删除{len(ids)}个块")
+        failures = self.delete_all(ids)
+        if failures:
+            print(f"{len(failures)}个块删除失败，重新删除")
+            failures = self.delete_all(list(failures))
+        for id, e in failures.items():
+            print(f"::warning::删除块失败 {id}：{e}")
+        return [group for group in groups if not any(id in failures for id in group)]
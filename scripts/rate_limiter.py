@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+
+import httpx
+
+# Notion限制每个集成平均每秒3个请求
+NOTION_RATE_LIMIT = float(os.getenv("NOTION_RATE_LIMIT", 3))
+NOTION_RATE_BURST = int(os.getenv("NOTION_RATE_BURST", 3))
+
+
+class TokenBucket:
+    """线程安全的令牌桶，有读请求在排队时写请求让读请求先走"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.waiting_reads = 0
+        self.condition = threading.Condition()
+
+    def refill(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def acquire(self, read=True):
+        with self.condition:
+            if read:
+                self.waiting_reads += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.refill(now)
+                    if now < self.paused_until:
+                        self.condition.wait(self.paused_until - now)
+                        continue
+                    if self.tokens >= 1 and (read or self.waiting_reads == 0):
+                        self.tokens -= 1
+                        return
+                    self.condition.wait(max((1 - self.tokens) / self.rate, 0.01))
+            finally:
+                if read:
+                    self.waiting_reads -= 1
+                    self.condition.notify_all()
+
+    def pause(self, seconds):
+        """收到429时所有请求都暂停seconds秒"""
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.condition.notify_all()
+
+
+def is_read_request(request):
+    path = request.url.path
+    return (
+        request.method == "GET" or path.endswith("/query") or path.endswith("/search")
+    )
+
+
+class ThrottledTransport(httpx.BaseTransport):
+    """所有经过这个transport的请求都要先从令牌桶中拿到令牌"""
+
+    def __init__(self, bucket, transport=None):
+        self.bucket = bucket
+        self.transport = transport if transport is not None else httpx.HTTPTransport()
+
+    def handle_request(self, request):
+        self.bucket.acquire(is_read_request(request))
+        response = self.transport.handle_request(request)
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.headers.get("Retry-After", 1))
+            except ValueError:
+                retry_after = 1
+            self.bucket.pause(retry_after)
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+# 同一个进程中所有Notion请求共用一个令牌桶
+notion_bucket = TokenBucket(NOTION_RATE_LIMIT, NOTION_RATE_BURST)
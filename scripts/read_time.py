@@ -7,7 +7,7 @@ import time
 
 import pendulum
 
-from notion_helper import NotionHelper
+from notion_helper import NotionHelper, RELATION_PRELOAD_THRESHOLD
 from weread_api import WeReadApi
 from utils import (
     format_date,
@@ -57,9 +57,12 @@ def insert_to_notion(page_id, timestamp, duration):
         ),
     }
     if page_id != None:
-        notion_helper.client.pages.update(page_id=page_id, properties=properties)
+        notion_helper.write_page(
+            notion_helper.client.pages.update, page_id=page_id, properties=properties
+        )
     else:
-        notion_helper.client.pages.create(
+        notion_helper.write_page(
+            notion_helper.client.pages.create,
             parent=parent,
             icon=get_icon("https://www.notion.so/icons/target_red.svg"),
             properties=properties,
@@ -88,7 +91,7 @@ if __name__ == "__main__":
     if image_file:
         image_url = f"https://raw.githubusercontent.com/{os.getenv('REPOSITORY')}/{os.getenv('REF').split('/')[-1]}/OUT_FOLDER/{image_file}"
         heatmap_url = f"https://heatmap.malinkang.com/?image={image_url}"
-        if notion_helper.heatmap_block_id:
+        if notion_helper.search_heatmap():
             response = notion_helper.update_heatmap(
                 block_id=notion_helper.heatmap_block_id, url=heatmap_url
             )
@@ -103,7 +106,9 @@ if __name__ == "__main__":
     if today_timestamp not in readTimes:
         readTimes[today_timestamp] = 0
     readTimes = dict(sorted(readTimes.items()))
-    results = notion_helper.query_all(database_id=notion_helper.day_database_id)
+    results = notion_helper.iter_query(
+        notion_helper.day_database_id, filter_properties=["时间戳", "时长"]
+    )
     for result in results:
         timestamp = result.get("properties").get("时间戳").get("number")
         duration = result.get("properties").get("时长").get("number")
@@ -112,5 +117,13 @@ if __name__ == "__main__":
             value = readTimes.pop(timestamp)
             if value != duration:
                 insert_to_notion(page_id=id, timestamp=timestamp, duration=value)
+    if len(readTimes) >= RELATION_PRELOAD_THRESHOLD:
+        notion_helper.preload_relations(
+            [
+                notion_helper.year_database_id,
+                notion_helper.month_database_id,
+                notion_helper.week_database_id,
+            ]
+        )
     for key, value in readTimes.items():
         insert_to_notion(None, int(key), value)
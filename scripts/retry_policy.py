@@ -0,0 +1,98 @@
+import atexit
+from collections import Counter
+from functools import wraps
+import os
+import random
+import time
+
+import httpx
+import requests
+from notion_client.errors import RequestTimeoutError
+
+# 这些状态码说明服务端暂时不可用或者被限流，可以重试
+RETRYABLE_STATUS = {409, 429, 500, 502, 503, 504}
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 5))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 1))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 60))
+
+# 每个接口的重试次数
+retry_counter = Counter()
+
+
+def get_status(exception):
+    """WeReadError使用status_code，notion_client的错误使用status"""
+    status = getattr(exception, "status_code", None)
+    if status is None:
+        status = getattr(exception, "status", None)
+    return status
+
+
+def is_retryable(exception):
+    retryable = getattr(exception, "retryable", None)
+    if retryable is not None:
+        return retryable
+    if isinstance(
+        exception,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            httpx.TransportError,
+            RequestTimeoutError,
+        ),
+    ):
+        return True
+    return get_status(exception) in RETRYABLE_STATUS
+
+
+def get_retry_after(exception):
+    headers = getattr(exception, "headers", None)
+    if not headers or not headers.get("Retry-After"):
+        return None
+    try:
+        return float(headers.get("Retry-After"))
+    except ValueError:
+        return None
+
+
+def get_delay(attempt, exception):
+    """优先使用服务端返回的Retry-After，否则使用带随机抖动的指数退避"""
+    retry_after = get_retry_after(exception)
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+
+def retry(endpoint=None, max_attempts=None):
+    """WeRead和Notion共用的重试策略，只重试可以重试的错误"""
+
+    def decorator(func):
+        name = endpoint or func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            attempts = max_attempts or RETRY_MAX_ATTEMPTS
+            attempt = 1
+            while True:
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    if attempt >= attempts or not is_retryable(e):
+                        raise
+                    delay = get_delay(attempt, e)
+                    retry_counter[name] += 1
+                    print(f"{name}失败，{delay:.1f}秒后进行第{attempt}次重试：{e}")
+                    time.sleep(delay)
+                    attempt += 1
+
+        return wrapper
+
+    return decorator
+
+
+def report():
+    if retry_counter:
+        for name, count in retry_counter.most_common():
+            print(f"{name}重试次数：{count}")
+
+
+atexit.register(report)
@@ -0,0 +1,83 @@
+import json
+import os
+import threading
+import time
+
+# 本地状态文件的目录，Github Action中通过actions/cache在多次运行之间保留
+STATE_DIR = os.getenv("STATE_DIR", ".weread2notion")
+
+
+def get_state_path(name):
+    return os.path.join(STATE_DIR, name)
+
+
+def load_state(name, default=None):
+    """读取状态文件，文件不存在或者损坏时返回default"""
+    path = get_state_path(name)
+    if default is None:
+        default = {}
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except ValueError:
+        print(f"状态文件{path}已损坏，将重新生成")
+        return default
+
+
+def save_state(name, data):
+    """先写临时文件再替换，避免写到一半被中断导致文件损坏"""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    path = get_state_path(name)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class DiskCache:
+    """持久化到状态目录的接口缓存
+
+    超过ttl秒的数据视为过期，数量超过max_size时淘汰最久没有使用的数据，
+    bypass为True时不读缓存但是仍然会用新结果刷新缓存
+    """
+
+    def __init__(self, name, ttl, max_size=5000, bypass=False):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.bypass = bypass
+        self.data = load_state(name)
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = None if self.bypass else self.data.get(key)
+            now = time.time()
+            if entry is None or now - entry.get("time", 0) > self.ttl:
+                self.misses += 1
+                return None
+            entry["used"] = now
+            self.dirty = True
+            self.hits += 1
+            return entry.get("value")
+
+    def set(self, key, value):
+        with self.lock:
+            now = time.time()
+            self.data[key] = {"time": now, "used": now, "value": value}
+            if len(self.data) > self.max_size:
+                keys = sorted(self.data, key=lambda x: self.data[x].get("used", 0))
+                for old_key in keys[: len(self.data) - self.max_size]:
+                    self.data.pop(old_key)
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if self.dirty:
+                save_state(self.name, self.data)
+                self.dirty = False
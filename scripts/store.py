@@ -0,0 +1,292 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from state import STATE_DIR
+
+STORE_NAME = "weread2notion.db"
+
+
+class SqliteStore:
+    """保存在状态目录中的SQLite数据库，子类通过schema定义自己的表"""
+
+    schema = ""
+
+    def __init__(self, path=None):
+        if path is None:
+            os.makedirs(STATE_DIR, exist_ok=True)
+            path = os.path.join(STATE_DIR, STORE_NAME)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript(self.schema)
+
+    def execute(self, sql, parameters=()):
+        with self.lock, self.connection:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def executemany(self, sql, parameters):
+        with self.lock, self.connection:
+            self.connection.executemany(sql, parameters)
+
+
+class RelationStore(SqliteStore):
+    """跨运行保存关联数据库中标题到页面ID的映射"""
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS relation (
+        database_id TEXT NOT NULL,
+        title TEXT NOT NULL,
+        page_id TEXT NOT NULL,
+        PRIMARY KEY (database_id, title)
+    );
+    """
+
+    def get(self, database_id, title):
+        rows = self.execute(
+            "SELECT page_id FROM relation WHERE database_id = ? AND title = ?",
+            (database_id, title),
+        )
+        return rows[0][0] if rows else None
+
+    def set(self, database_id, title, page_id):
+        self.set_many([(database_id, title, page_id)])
+
+    def set_many(self, rows):
+        self.executemany("INSERT OR REPLACE INTO relation VALUES (?, ?, ?)", rows)
+
+    def delete(self, page_id):
+        self.execute("DELETE FROM relation WHERE page_id = ?", (page_id,))
+
+
+class NoteMirror(SqliteStore):
+    """本地保存已经同步到Notion的划线、笔记和章节
+
+    kind是bookmark、review或chapter，note_id对应bookmarkId、reviewId或chapterUid，
+    fingerprint是写入Notion的内容的指纹，用来发现微信读书中修改过的笔记，
+    abstract_fingerprint是笔记摘抄的指纹，摘抄没有修改时不用更新引用块，
+    mirrored_book记录哪些书的哪类笔记已经完整保存在本地，以及上次从Notion核对的时间
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS note (
+        book_page_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        note_id TEXT NOT NULL,
+        block_id TEXT NOT NULL,
+        page_id TEXT,
+        fingerprint TEXT,
+        abstract_fingerprint TEXT,
+        PRIMARY KEY (book_page_id, kind, note_id)
+    );
+    CREATE INDEX IF NOT EXISTS note_block_id ON note (block_id);
+    CREATE TABLE IF NOT EXISTS mirrored_book (
+        book_page_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        verified_at REAL,
+        PRIMARY KEY (book_page_id, kind)
+    );
+    """
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        columns = [x[1] for x in self.execute("PRAGMA table_info(note)")]
+        if "fingerprint" not in columns:
+            # 旧的镜像没有指纹，全部从Notion重新查询
+            self.execute("ALTER TABLE note ADD COLUMN fingerprint TEXT")
+            self.execute("DELETE FROM mirrored_book")
+        if "abstract_fingerprint" not in columns:
+            # 旧的行没有摘抄的指纹，修改时按摘抄也修改过处理
+            self.execute("ALTER TABLE note ADD COLUMN abstract_fingerprint TEXT")
+        columns = [x[1] for x in self.execute("PRAGMA table_info(mirrored_book)")]
+        if "verified_at" not in columns:
+            # 旧的数据没有核对时间，下次使用时从Notion重新查询
+            self.execute("ALTER TABLE mirrored_book ADD COLUMN verified_at REAL")
+
+    def is_mirrored(self, book_page_id, kind, max_age):
+        """这本书的这类笔记在本地有完整的镜像，并且上次核对不超过max_age秒"""
+        rows = self.execute(
+            "SELECT 1 FROM mirrored_book"
+            " WHERE book_page_id = ? AND kind = ? AND verified_at >= ?",
+            (book_page_id, kind, time.time() - max_age),
+        )
+        return len(rows) > 0
+
+    def get_notes(self, book_page_id, kind):
+        """返回(note_id, block_id, page_id, fingerprint, abstract_fingerprint)的列表"""
+        return self.execute(
+            "SELECT note_id, block_id, page_id, fingerprint, abstract_fingerprint"
+            " FROM note"
+            " WHERE book_page_id = ? AND kind = ?",
+            (book_page_id, kind),
+        )
+
+    def replace_notes(self, book_page_id, kind, rows):
+        """用从Notion查询到的数据覆盖本地镜像"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM note WHERE book_page_id = ? AND kind = ?",
+                (book_page_id, kind),
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO note VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(book_page_id, kind, str(x[0]), *x[1:]) for x in rows],
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO mirrored_book VALUES (?, ?, ?)",
+                (book_page_id, kind, time.time()),
+            )
+
+    def forget(self, book_page_id):
+        """下次使用时从Notion重新查询这本书的全部笔记"""
+        self.execute(
+            "DELETE FROM mirrored_book WHERE book_page_id = ?", (book_page_id,)
+        )
+
+    def add_note(
+        self,
+        book_page_id,
+        kind,
+        note_id,
+        block_id,
+        page_id,
+        fingerprint=None,
+        abstract_fingerprint=None,
+        journal_key=None,
+    ):
+        """journal_key不为空时在同一个事务中把SyncJournal中对应的块标记为已写入
+
+        日志和镜像在同一个数据库中，这样中断时不会出现镜像中有、日志中却没有写入的行
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO note VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    book_page_id,
+                    kind,
+                    str(note_id),
+                    block_id,
+                    page_id,
+                    fingerprint,
+                    abstract_fingerprint,
+                ),
+            )
+            if journal_key is not None:
+                self.connection.execute(
+                    "UPDATE journal SET inserted = 1"
+                    " WHERE book_page_id = ? AND content_key = ?",
+                    (book_page_id, journal_key),
+                )
+
+    def set_fingerprint(self, block_id, fingerprint, abstract_fingerprint=None):
+        self.execute(
+            "UPDATE note SET fingerprint = ?, abstract_fingerprint = ?"
+            " WHERE block_id = ?",
+            (fingerprint, abstract_fingerprint, block_id),
+        )
+
+    def delete_block(self, block_id):
+        self.execute("DELETE FROM note WHERE block_id = ?", (block_id,))
+
+
+class SyncJournal(SqliteStore):
+    """记录同步一本书时已经写入的块和数据库行
+
+    content_key是kind:note_id，块写入成功时记录block_id，数据库行写入成功时inserted为1，
+    同步中断后下次运行可以从中断的地方继续，不会重复写入
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS journal (
+        book_page_id TEXT NOT NULL,
+        content_key TEXT NOT NULL,
+        block_id TEXT NOT NULL,
+        inserted INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (book_page_id, content_key)
+    );
+    """
+
+    def get(self, book_page_id):
+        """返回content_key到(block_id, inserted)的字典"""
+        rows = self.execute(
+            "SELECT content_key, block_id, inserted FROM journal"
+            " WHERE book_page_id = ?",
+            (book_page_id,),
+        )
+        return {x[0]: (x[1], bool(x[2])) for x in rows}
+
+    def add_blocks(self, book_page_id, rows):
+        self.executemany(
+            "INSERT OR REPLACE INTO journal VALUES (?, ?, ?, 0)",
+            [(book_page_id, key, block_id) for key, block_id in rows],
+        )
+
+    def clear(self, book_page_id):
+        self.execute("DELETE FROM journal WHERE book_page_id = ?", (book_page_id,))
+
+
+class NoteSnapshot(SqliteStore):
+    """保存每本书上次从微信读书获取的划线和笔记，以及当时笔记本列表中的数量
+
+    数量没有变化时直接使用保存的数据，不再请求微信读书。served是第一次用保存的
+    数据代替请求的时间，数量不变时的修改需要在对账时重新获取才能发现
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS snapshot (
+        book_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        counts TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        time REAL,
+        served REAL,
+        PRIMARY KEY (book_id, kind)
+    );
+    """
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        columns = [x[1] for x in self.execute("PRAGMA table_info(snapshot)")]
+        if "time" not in columns:
+            # 旧的数据没有保存时间，视为已经过期
+            self.execute("ALTER TABLE snapshot ADD COLUMN time REAL")
+        if "served" not in columns:
+            self.execute("ALTER TABLE snapshot ADD COLUMN served REAL")
+
+    def get(self, book_id, kind, counts, max_age):
+        """数量和保存时一样并且保存不超过max_age秒时返回保存的数据，否则返回None"""
+        rows = self.execute(
+            "SELECT payload FROM snapshot"
+            " WHERE book_id = ? AND kind = ? AND counts = ? AND time >= ?",
+            (book_id, kind, json.dumps(counts), time.time() - max_age),
+        )
+        if not rows:
+            return None
+        self.execute(
+            "UPDATE snapshot SET served = COALESCE(served, ?)"
+            " WHERE book_id = ? AND kind = ?",
+            (time.time(), book_id, kind),
+        )
+        return json.loads(rows[0][0])
+
+    def get_unreconciled(self, max_age):
+        """用保存的数据代替过请求、并且保存已经超过max_age秒的书"""
+        rows = self.execute(
+            "SELECT DISTINCT book_id FROM snapshot"
+            " WHERE served IS NOT NULL AND time < ?",
+            (time.time() - max_age,),
+        )
+        return {x[0] for x in rows}
+
+    def set_many(self, rows):
+        """rows是(book_id, kind, counts, payload)的列表"""
+        now = time.time()
+        self.executemany(
+            "INSERT OR REPLACE INTO snapshot VALUES (?, ?, ?, ?, ?, NULL)",
+            [
+                (book_id, kind, json.dumps(counts), json.dumps(payload), now)
+                for book_id, kind, counts, payload in rows
+            ],
+        )
@@ -157,6 +157,12 @@ def get_rich_text_from_result(result, name):
     return result.get("properties").get(name).get("rich_text")[0].get("plain_text")
 
 
+def get_text_from_result(result, name):
+    """拼接title或者rich_text属性的全部文本，属性为空时返回空字符串"""
+    property = result.get("properties").get(name)
+    return "".join(x.get("plain_text") for x in property.get(property.get("type"), []))
+
+
 def get_number_from_result(result, name):
     return result.get("properties").get(name).get("number")
 
@@ -1,11 +1,32 @@
 import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
 import os
+from queue import Full, Queue
+import sys
+import threading
 import requests
 
-from notion_helper import NotionHelper
-from weread_api import WeReadApi
+from notion_client.errors import APIResponseError
+from notion_helper import (
+    DeletionQueue,
+    NotionHelper,
+    NOTION_WORKERS,
+    RELATION_PRELOAD_THRESHOLD,
+)
+from store import NoteMirror, NoteSnapshot, SyncJournal
+from weread_api import (
+    AsyncWeReadApi,
+    FULL_SYNC,
+    WeReadApi,
+    WeReadAuthError,
+    WEREAD_CONCURRENCY,
+)
 
 from utils import (
+    MAX_LENGTH,
     get_callout,
     get_heading,
     get_number,
@@ -13,11 +34,95 @@ from utils import (
     get_quote,
     get_rich_text_from_result,
     get_table_of_contents,
+    get_text_from_result,
+)
+
+# 每种笔记在微信读书中的ID字段
+NOTE_KEYS = {"bookmark": "bookmarkId", "review": "reviewId", "chapter": "chapterUid"}
+# 计算内容指纹时需要从Notion查询的属性
+FINGERPRINT_PROPERTIES = {
+    "bookmark": ["Name", "style", "colorStyle"],
+    "review": ["Name", "abstract"],
+    "chapter": [],
+}
+# 本地保存的划线和笔记的对账周期，数量不变时的修改最晚在这个时间后同步
+NOTE_RECONCILE_INTERVAL = int(
+    os.getenv("WEREAD_NOTE_RECONCILE_INTERVAL", 7 * 24 * 3600)
 )
+# 本地镜像的核对周期，超过后从Notion重新查询一本书已经同步的笔记
+NOTE_MIRROR_VERIFY_INTERVAL = int(
+    os.getenv("WEREAD_NOTE_MIRROR_VERIFY_INTERVAL", 7 * 24 * 3600)
+)
+# 流水线中已经对比完等待写入Notion的书的数量，决定了内存中最多保存多少本书的笔记
+PIPELINE_DEPTH = int(os.getenv("WEREAD_PIPELINE_DEPTH", 4))
 
 
-def get_bookmark_list(page_id, bookId):
-    """获取我的划线"""
+def get_kind(value):
+    if "bookmarkId" in value:
+        return "bookmark"
+    if "reviewId" in value:
+        return "review"
+    return "chapter"
+
+
+def get_fingerprint(kind, value):
+    """计算划线和笔记写入Notion的内容的指纹，章节不计算
+
+    文本和写入Notion时一样截断，这样从Notion查询到的行也能算出同样的指纹
+    """
+    if kind == "bookmark":
+        fields = [
+            (value.get("markText") or "")[:MAX_LENGTH],
+            value.get("style"),
+            value.get("colorStyle"),
+        ]
+    elif kind == "review":
+        fields = [
+            (value.get("content") or "")[:MAX_LENGTH],
+            (value.get("abstract") or "")[:MAX_LENGTH],
+        ]
+    else:
+        return None
+    data = json.dumps(fields, ensure_ascii=False).encode("utf-8")
+    return hashlib.md5(data).hexdigest()
+
+
+def get_abstract_fingerprint(kind, value):
+    """笔记摘抄的指纹，和内容的指纹分开保存，摘抄没有修改时不用更新引用块"""
+    if kind != "review":
+        return None
+    data = (value.get("abstract") or "")[:MAX_LENGTH].encode("utf-8")
+    return hashlib.md5(data).hexdigest()
+
+
+def get_fingerprint_from_result(kind, result):
+    if kind == "bookmark":
+        value = {
+            "markText": get_text_from_result(result, "Name"),
+            "style": get_number_from_result(result, "style"),
+            "colorStyle": get_number_from_result(result, "colorStyle"),
+        }
+    elif kind == "review":
+        value = {
+            "content": get_text_from_result(result, "Name"),
+            "abstract": get_text_from_result(result, "abstract"),
+        }
+    else:
+        return None
+    return get_fingerprint(kind, value)
+
+
+def query_synced_notes(page_id, kind):
+    """从Notion查询一本书已经同步的笔记
+
+    返回(note_id, block_id, page_id, fingerprint, abstract_fingerprint)的列表
+    """
+    database_id = {
+        "bookmark": notion_helper.bookmark_database_id,
+        "review": notion_helper.review_database_id,
+        "chapter": notion_helper.chapter_database_id,
+    }[kind]
+    key = NOTE_KEYS[kind]
     filter = {
         "and": [
             {"property": "书籍", "relation": {"contains": page_id}},
@@ -25,49 +130,331 @@ def get_bookmark_list(page_id, bookId):
         ]
     }
     results = notion_helper.query_all_by_book(
-        notion_helper.bookmark_database_id, filter
+        database_id,
+        filter,
+        filter_properties=[key, "blockId"] + FINGERPRINT_PROPERTIES[kind],
     )
-    dict1 = {
-        get_rich_text_from_result(x, "bookmarkId"): get_rich_text_from_result(
-            x, "blockId"
+    rows = []
+    for x in results:
+        if kind == "chapter":
+            note_id = get_number_from_result(x, key)
+            note_id = None if note_id is None else int(note_id)
+        else:
+            note_id = get_rich_text_from_result(x, key)
+        abstract = get_text_from_result(x, "abstract") if kind == "review" else None
+        rows.append(
+            (
+                note_id,
+                get_rich_text_from_result(x, "blockId"),
+                x.get("id"),
+                get_fingerprint_from_result(kind, x),
+                get_abstract_fingerprint(kind, {"abstract": abstract}),
+            )
         )
-        for x in results
-    }
-    dict2 = {get_rich_text_from_result(x, "blockId"): x.get("id") for x in results}
-    bookmarks = weread_api.get_bookmark_list(bookId)
-    for i in bookmarks:
-        if i.get("bookmarkId") in dict1:
-            i["blockId"] = dict1.pop(i.get("bookmarkId"))
-    for blockId in dict1.values():
-        notion_helper.delete_block(blockId)
-        notion_helper.delete_block(dict2.get(blockId))
-    return bookmarks
-
-
-def get_review_list(page_id,bookId):
+    return rows
+
+
+def get_synced_notes(page_id, kind):
+    """获取一本书已经同步的笔记
+
+    返回note_id到(block_id, page_id, fingerprint, abstract_fingerprint)的字典
+
+    本地镜像中有这本书并且没有超过核对周期时直接使用镜像，
+    否则或者指定了--verify时从Notion查询并重建镜像
+    """
+    if not options.verify and note_mirror.is_mirrored(
+        page_id, kind, NOTE_MIRROR_VERIFY_INTERVAL
+    ):
+        rows = note_mirror.get_notes(page_id, kind)
+    else:
+        rows = query_synced_notes(page_id, kind)
+        note_mirror.replace_notes(page_id, kind, rows)
+    return {str(x[0]): tuple(x[1:]) for x in rows}
+
+
+def diff_notes(page_id, kind, notes, deletions):
+    """把微信读书中的笔记和已经同步的笔记对比
+
+    已经同步的设置blockId，内容修改过的用changed记录数据库行的ID，
+    其中摘抄也修改过的设置abstractChanged，
+    Notion中多余的加入这本书的删除队列deletions，剩下没有blockId的就是新增的
+    """
+    synced = get_synced_notes(page_id, kind)
+    for note in notes:
+        key = str(note.get(NOTE_KEYS[kind]))
+        if key in synced:
+            block_id, row_id, fingerprint, abstract_fingerprint = synced.pop(key)
+            note["blockId"] = block_id
+            if fingerprint != get_fingerprint(kind, note):
+                note["changed"] = row_id
+                if abstract_fingerprint != get_abstract_fingerprint(kind, note):
+                    note["abstractChanged"] = True
+    delete_notes(synced.values(), deletions)
+    return notes
+
+
+def reverify_notes(page_id, content, deletions):
+    """丢弃一本书的本地镜像，从Notion重新查询已经同步的笔记后重新对比"""
+    note_mirror.forget(page_id)
+    notes = {}
+    for note in content:
+        note.pop("blockId", None)
+        note.pop("changed", None)
+        note.pop("abstractChanged", None)
+        notes.setdefault(get_kind(note), []).append(note)
+    # 没有章节信息时sort_notes不对比章节，这里也一样
+    kinds = ["bookmark", "review"] + (["chapter"] if "chapter" in notes else [])
+    for kind in kinds:
+        diff_notes(page_id, kind, notes.get(kind, []), deletions)
+
+
+def delete_notes(notes, deletions):
+    """把Notion中已经不存在于微信读书的笔记块和数据库行加入删除队列"""
+    for block_id, row_id, *_ in notes:
+        deletions.add(block_id, row_id)
+
+
+def flush_deletions(deletions):
+    """并发删除队列中的块和数据库行，删除成功的从镜像中移除
+
+    删除队列都要通过这里清空，否则镜像中会留下已经删除的块
+    """
+    for group in deletions.flush():
+        note_mirror.delete_block(group[0])
+
+
+def get_bookmark_list(page_id, bookmarks, deletions):
+    """获取我的划线"""
+    return diff_notes(page_id, "bookmark", bookmarks, deletions)
+
+
+def get_review_list(page_id, reviews, deletions):
     """获取笔记"""
-    filter = {
-        "and": [
-            {"property": "书籍", "relation": {"contains": page_id}},
-            {"property": "blockId", "rich_text": {"is_not_empty": True}},
-        ]
-    }
-    results = notion_helper.query_all_by_book(notion_helper.review_database_id, filter)
-    dict1 = {
-        get_rich_text_from_result(x, "reviewId"): get_rich_text_from_result(
-            x, "blockId"
-        )
-        for x in results
+    return diff_notes(page_id, "review", reviews, deletions)
+
+
+def update_abstract(block_id, abstract, deletions):
+    """同步笔记下面摘抄的引用块"""
+    quotes = [
+        x.get("id")
+        for x in notion_helper.get_block_children(block_id)
+        if x.get("type") == "quote"
+    ]
+    if abstract:
+        if quotes:
+            notion_helper.update_block(quotes.pop(0), get_quote(abstract))
+        else:
+            notion_helper.append_blocks(
+                block_id=block_id, children=[get_quote(abstract)]
+            )
+    for quote in quotes:
+        deletions.add(quote)
+
+
+def update_note(note, deletions):
+    """原地更新修改过的划线或笔记，只更新callout块和数据库行"""
+    kind = get_kind(note)
+    block_id = note.get("blockId")
+    notion_helper.update_block(block_id, content_to_block(note, children=False))
+    if kind == "bookmark":
+        notion_helper.update_bookmark(note.get("changed"), note)
+    else:
+        notion_helper.update_review(note.get("changed"), note)
+        if note.get("abstractChanged"):
+            update_abstract(block_id, note.get("abstract"), deletions)
+    note_mirror.set_fingerprint(
+        block_id, get_fingerprint(kind, note), get_abstract_fingerprint(kind, note)
+    )
+
+
+def update_notes(contents, deletions):
+    """并发更新内容修改过的笔记，返回失败的数量，失败的下次同步时会重新更新"""
+    changed = [x for x in contents if x.get("changed")]
+    if not changed:
+        return 0
+    print(f"更新{len(changed)}条修改过的笔记")
+    failures = 0
+    with ThreadPoolExecutor(max_workers=NOTION_WORKERS) as executor:
+        futures = {executor.submit(update_note, x, deletions): x for x in changed}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"::warning::更新笔记失败 {futures[future].get('blockId')}：{e}")
+                failures += 1
+    flush_deletions(deletions)
+    return failures
+
+
+def get_note_counts(book, kind):
+    """笔记本列表中和每种笔记相关的数量，列表中没有这些数量时返回None"""
+    if kind == "bookmark":
+        counts = [book.get("noteCount"), book.get("bookmarkCount")]
+    else:
+        counts = [book.get("reviewCount")]
+    return None if None in counts else counts
+
+
+def get_snapshot(book, kind):
+    """数量和上次获取时一样时返回本地保存的划线或笔记
+
+    数量不变时也可能有修改，例如修改了划线颜色或者删除一条再新增一条，
+    这些修改由NOTE_RECONCILE_INTERVAL的对账重新获取后同步
+    """
+    counts = get_note_counts(book, kind)
+    if FULL_SYNC or counts is None:
+        return None
+    return note_snapshot.get(
+        book.get("bookId"), kind, counts, NOTE_RECONCILE_INTERVAL
+    )
+
+
+async def fetch_notes(batch):
+    """并发获取一批书的章节、划线和笔记
+
+    划线或笔记的数量和上次一样时使用本地保存的数据，不再请求，
+    划线没有变化并且本地有章节信息时也不再请求章节
+    """
+    bookmark_lists = {}
+    review_lists = {}
+    for _, book in batch:
+        for kind, lists in (("bookmark", bookmark_lists), ("review", review_lists)):
+            snapshot = get_snapshot(book, kind)
+            if snapshot is not None:
+                lists[book.get("bookId")] = snapshot
+    chapter_infos = {}
+    for bookId in bookmark_lists:
+        chapter = weread_api.get_cached_chapter_info(bookId)
+        if chapter is not None:
+            chapter_infos[bookId] = chapter
+    bookIds = [book.get("bookId") for _, book in batch]
+    async_api = AsyncWeReadApi(weread_api)
+    chapters, bookmarks, reviews = await asyncio.gather(
+        async_api.get_chapter_infos([x for x in bookIds if x not in chapter_infos]),
+        async_api.gather(
+            async_api.get_bookmark_list, [x for x in bookIds if x not in bookmark_lists]
+        ),
+        async_api.gather(
+            async_api.get_review_list, [x for x in bookIds if x not in review_lists]
+        ),
+    )
+    skipped = len(bookmark_lists) + len(review_lists)
+    if skipped:
+        print(f"{skipped}个划线或笔记列表没有变化，使用本地保存的数据")
+    batch_books = {book.get("bookId"): book for _, book in batch}
+    rows = []
+    for kind, lists in (("bookmark", bookmarks), ("review", reviews)):
+        for bookId, payload in lists.items():
+            counts = get_note_counts(batch_books.get(bookId), kind)
+            if counts is not None:
+                rows.append((bookId, kind, counts, payload))
+    note_snapshot.set_many(rows)
+    chapter_infos.update(chapters)
+    bookmark_lists.update(bookmarks)
+    review_lists.update(reviews)
+    return chapter_infos, bookmark_lists, review_lists
+
+
+def put(output, item, stop):
+    """队列满时等待，消费者退出后不再等待"""
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=1)
+            return
+        except Full:
+            continue
+
+
+def produce(sync_books, output, stop):
+    """生产者：分批从微信读书获取笔记，和已经同步的笔记对比后放入队列
+
+    出错时把异常放入队列交给消费者处理，最后放入None表示结束
+    """
+    try:
+        # 每次并发获取一批书的数据，避免一次把所有书的笔记都放进内存
+        batch_size = WEREAD_CONCURRENCY * 2
+        for start in range(0, len(sync_books), batch_size):
+            if stop.is_set():
+                return
+            batch = sync_books[start : start + batch_size]
+            chapter_infos, bookmark_lists, review_lists = asyncio.run(
+                fetch_notes(batch)
+            )
+            for index, book in batch:
+                if stop.is_set():
+                    return
+                bookId = book.get("bookId")
+                pageId = notion_books.get(bookId).get("pageId")
+                # 每本书使用自己的删除队列，由消费者在写入这本书时清空
+                deletions = DeletionQueue(notion_helper)
+                bookmark_list = get_bookmark_list(
+                    pageId, bookmark_lists.pop(bookId), deletions
+                )
+                reviews = get_review_list(pageId, review_lists.pop(bookId), deletions)
+                bookmark_list.extend(reviews)
+                chapter = chapter_infos.pop(bookId, None)
+                content = sort_notes(pageId, chapter, bookmark_list, deletions)
+                put(output, (index, book, pageId, content, deletions), stop)
+    except Exception as e:
+        put(output, e, stop)
+    finally:
+        put(output, None, stop)
+
+
+def write_book(index, book, pageId, content, deletions):
+    """消费者：把一本书对比的结果写入Notion，全部成功后更新Sort"""
+    title = book.get("book").get("title")
+    print(f"正在同步《{title}》,一共{len(books)}本，当前是第{index+1}本。")
+    flush_deletions(deletions)
+    failures = update_notes(content, deletions)
+    failures += append_blocks(pageId, content, deletions)
+    # 写入失败的块已经删除，日志只用来恢复被中断的同步
+    sync_journal.clear(pageId)
+    if failures > 0:
+        # 不更新Sort，下次同步时重新处理这本书
+        print(f"::warning::《{title}》有{failures}条笔记写入失败")
+        return
+    properties = {
+        "Sort":get_number(book.get("sort"))
     }
-    dict2 = {get_rich_text_from_result(x, "blockId"): x.get("id") for x in results}
-    reviews = weread_api.get_review_list(bookId)
-    for i in reviews:
-        if i.get("reviewId") in dict1:
-            i["blockId"] = dict1.pop(i.get("reviewId"))
-    for blockId in dict1.values():
-        notion_helper.delete_block(blockId)
-        notion_helper.delete_block(dict2.get(blockId))
-    return reviews
+    notion_helper.update_book_page(page_id=pageId,properties=properties)
+
+
+def sync(sync_books):
+    """微信读书的请求和Notion的写入分别在两个线程中进行
+
+    生产者最多领先PIPELINE_DEPTH本书，写入Notion的顺序和原来一样
+    """
+    output = Queue(maxsize=PIPELINE_DEPTH)
+    stop = threading.Event()
+    producer = threading.Thread(
+        target=produce, args=(sync_books, output, stop), daemon=True
+    )
+    producer.start()
+    try:
+        while True:
+            item = output.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            try:
+                write_book(*item)
+            except APIResponseError as e:
+                index, book, pageId, content, deletions = item
+                bookId = book.get("bookId")
+                if notion_helper.handle_dead_book_page(bookId, pageId, e):
+                    continue
+                if options.verify:
+                    raise
+                # 镜像中的块可能已经在Notion中删除，用作锚点时写入会失败，
+                # 从Notion重新查询这本书已经同步的笔记后再试一次
+                print(f"::warning::写入失败，重新核对已经同步的笔记后重试：{e}")
+                reverify_notes(pageId, content, deletions)
+                write_book(*item)
+    finally:
+        stop.set()
+        producer.join()
 
 
 def check(bookId):
@@ -126,7 +513,7 @@ def download_image(url, save_dir="cover"):
     return save_path
 
 
-def sort_notes(page_id, chapter, bookmark_list):
+def sort_notes(page_id, chapter, bookmark_list, deletions):
     """对笔记进行排序"""
     bookmark_list = sorted(
         bookmark_list,
@@ -140,17 +527,7 @@ def sort_notes(page_id, chapter, bookmark_list):
 
     notes = []
     if chapter != None:
-        filter = {"property": "书籍", "relation": {"contains": page_id}}
-        results = notion_helper.query_all_by_book(
-            notion_helper.chapter_database_id, filter
-        )
-        dict1 = {
-            get_number_from_result(x, "chapterUid"): get_rich_text_from_result(
-                x, "blockId"
-            )
-            for x in results
-        }
-        dict2 = {get_rich_text_from_result(x, "blockId"): x.get("id") for x in results}
+        synced = get_synced_notes(page_id, "chapter")
         d = {}
         for data in bookmark_list:
             chapterUid = data.get("chapterUid", 1)
@@ -159,19 +536,17 @@ def sort_notes(page_id, chapter, bookmark_list):
             d[chapterUid].append(data)
         for key, value in d.items():
             if key in chapter:
-                if key in dict1:
-                    chapter.get(key)["blockId"] = dict1.pop(key)
+                if str(key) in synced:
+                    chapter.get(key)["blockId"] = synced.pop(str(key))[0]
                 notes.append(chapter.get(key))
             notes.extend(value)
-        for blockId in dict1.values():
-            notion_helper.delete_block(blockId)
-            notion_helper.delete_block(dict2.get(blockId))
+        delete_notes(synced.values(), deletions)
     else:
         notes.extend(bookmark_list)
     return notes
 
 
-def append_blocks(id, contents):
+def append_blocks(id, contents, deletions):
     print(f"笔记数{len(contents)}")
     before_block_id = ""
     block_children = notion_helper.get_block_children(id)
@@ -182,19 +557,12 @@ def append_blocks(id, contents):
             block_id=id, children=[get_table_of_contents()]
         )
         before_block_id = response.get("results")[0].get("id")
+    pending = resume_blocks(id, contents, deletions)
     blocks = []
     sub_contents = []
     l = []
     for content in contents:
-        if len(blocks) == 100:
-            results = append_blocks_to_notion(id, blocks, before_block_id, sub_contents)
-            before_block_id = results[-1].get("blockId")
-            l.extend(results)
-            blocks.clear()
-            sub_contents.clear()
-            blocks.append(content_to_block(content))
-            sub_contents.append(content)
-        elif "blockId" in content:
+        if "blockId" in content:
             if len(blocks) > 0:
                 l.extend(
                     append_blocks_to_notion(id, blocks, before_block_id, sub_contents)
@@ -202,23 +570,99 @@ def append_blocks(id, contents):
                 blocks.clear()
                 sub_contents.clear()
             before_block_id = content["blockId"]
-        else:
-            blocks.append(content_to_block(content))
-            sub_contents.append(content)
+            continue
+        if len(blocks) == 100:
+            results = append_blocks_to_notion(id, blocks, before_block_id, sub_contents)
+            before_block_id = results[-1].get("blockId")
+            l.extend(results)
+            blocks.clear()
+            sub_contents.clear()
+        blocks.append(content_to_block(content))
+        sub_contents.append(content)
 
     if len(blocks) > 0:
         l.extend(append_blocks_to_notion(id, blocks, before_block_id, sub_contents))
-    for index, value in enumerate(l):
-        print(f"正在插入第{index+1}条笔记，共{len(l)}条")
-        if "bookmarkId" in value:
-            notion_helper.insert_bookmark(id, value)
-        elif "reviewId" in value:
-            notion_helper.insert_review(id, value)
-        else:
-            notion_helper.insert_chapter(id, value)
+    return insert_rows(id, pending + l, deletions)
+
+
+def get_content_key(content):
+    kind = get_kind(content)
+    return f"{kind}:{content.get(NOTE_KEYS[kind])}"
 
 
-def content_to_block(content):
+def resume_blocks(id, contents, deletions):
+    """从日志中恢复上次同步中断时已经写入块、但还没有写入数据库行的笔记
+
+    这些笔记直接使用已经写入的块，返回它们用于补写数据库行，
+    日志中已经不存在于微信读书的笔记的块加入删除队列，已经作为blockId使用的块除外
+    """
+    journal = sync_journal.get(id)
+    if not journal:
+        return []
+    pending = []
+    used = set()
+    for content in contents:
+        if "blockId" in content:
+            used.add(content["blockId"])
+            continue
+        entry = journal.pop(get_content_key(content), None)
+        if entry is not None and not entry[1]:
+            content["blockId"] = entry[0]
+            pending.append(content)
+    for block_id, inserted in journal.values():
+        if not inserted and block_id not in used:
+            deletions.add(block_id)
+    flush_deletions(deletions)
+    if pending:
+        print(f"从上次中断的地方继续，{len(pending)}条笔记的块已经写入")
+    return pending
+
+
+def insert_row(id, value):
+    kind = get_kind(value)
+    if kind == "bookmark":
+        page = notion_helper.insert_bookmark(id, value)
+    elif kind == "review":
+        page = notion_helper.insert_review(id, value)
+    else:
+        page = notion_helper.insert_chapter(id, value)
+    note_mirror.add_note(
+        id,
+        kind,
+        value.get(NOTE_KEYS[kind]),
+        value.get("blockId"),
+        page.get("id"),
+        get_fingerprint(kind, value),
+        get_abstract_fingerprint(kind, value),
+        journal_key=get_content_key(value),
+    )
+
+
+def insert_rows(id, contents, deletions):
+    """并发写入划线、笔记和章节的数据库行，单条失败不影响其他的
+
+    块的顺序在append_blocks中已经确定，数据库行之间没有顺序，所以可以并发写入。
+    写入失败的行会删除对应的块，下次同步时重新插入，返回失败的数量
+    """
+    failures = []
+    with ThreadPoolExecutor(max_workers=NOTION_WORKERS) as executor:
+        futures = {executor.submit(insert_row, id, value): value for value in contents}
+        for index, future in enumerate(as_completed(futures)):
+            print(f"正在插入第{index+1}条笔记，共{len(contents)}条")
+            try:
+                future.result()
+            except Exception as e:
+                value = futures[future]
+                print(f"::warning::插入笔记失败 {value.get('blockId')}：{e}")
+                failures.append(value)
+    for value in failures:
+        deletions.add(value.get("blockId"))
+    flush_deletions(deletions)
+    return len(failures)
+
+
+def content_to_block(content, children=True):
+    """children为True时把笔记的摘抄作为callout的子块，和callout一起写入"""
     if "bookmarkId" in content:
         return get_callout(
             content.get("markText",""),
@@ -227,17 +671,21 @@ def content_to_block(content):
             content.get("reviewId"),
         )
     elif "reviewId" in content:
-        return get_callout(
+        block = get_callout(
             content.get("content",""),
             content.get("style"),
             content.get("colorStyle"),
             content.get("reviewId"),
         )
+        if children and content.get("abstract"):
+            block["callout"]["children"] = [get_quote(content.get("abstract"))]
+        return block
     else:
         return get_heading(content.get("level"), content.get("title"))
 
 
 def append_blocks_to_notion(id, blocks, after, contents):
+    """摘抄已经作为子块包含在blocks中，返回结果中只有顶层的块，和contents一一对应"""
     response = notion_helper.append_blocks_after(
         block_id=id, children=blocks, after=after
     )
@@ -245,43 +693,47 @@ def append_blocks_to_notion(id, blocks, after, contents):
     l = []
     for index, content in enumerate(contents):
         result = results[index]
-        if content.get("abstract") != None and content.get("abstract") != "":
-            notion_helper.append_blocks(
-                block_id=result.get("id"), children=[get_quote(content.get("abstract"))]
-            )
         content["blockId"] = result.get("id")
         l.append(content)
+    sync_journal.add_blocks(id, [(get_content_key(x), x.get("blockId")) for x in l])
     return l
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--verify", action="store_true", help="忽略本地镜像，从Notion重新查询已同步的笔记"
+    )
     options = parser.parse_args()
     branch = os.getenv("REF").split("/")[-1]
     repository =  os.getenv("REPOSITORY")
     weread_api = WeReadApi()
     notion_helper = NotionHelper()
+    note_mirror = NoteMirror()
+    sync_journal = SyncJournal()
+    note_snapshot = NoteSnapshot()
     notion_books = notion_helper.get_all_book()
-    books = weread_api.get_notebooklist()
-    print(len(books))
-    if books != None:
-        for index, book in enumerate(books):
-            bookId = book.get("bookId")
-            title = book.get("book").get("title")
-            sort = book.get("sort")
-            if bookId not in notion_books:
-                continue
-            if sort == notion_books.get(bookId).get("Sort"):
-                continue
-            pageId = notion_books.get(bookId).get("pageId")
-            print(f"正在同步《{title}》,一共{len(books)}本，当前是第{index+1}本。")
-            chapter = weread_api.get_chapter_info(bookId)
-            bookmark_list = get_bookmark_list(pageId, bookId)
-            reviews = get_review_list(pageId,bookId)
-            bookmark_list.extend(reviews)
-            content = sort_notes(pageId, chapter, bookmark_list)
-            append_blocks(pageId, content)
-            properties = {
-                "Sort":get_number(sort)
-            }
-            notion_helper.update_book_page(page_id=pageId,properties=properties)
+    try:
+        books = weread_api.get_notebooklist()
+        print(len(books))
+        if books != None:
+            # 用本地数据代替过请求的书超过对账周期后，Sort没有变化也重新获取一次
+            unreconciled = note_snapshot.get_unreconciled(NOTE_RECONCILE_INTERVAL)
+            sync_books = []
+            for index, book in enumerate(books):
+                bookId = book.get("bookId")
+                if bookId not in notion_books:
+                    continue
+                if (
+                    book.get("sort") == notion_books.get(bookId).get("Sort")
+                    and bookId not in unreconciled
+                ):
+                    continue
+                sync_books.append((index, book))
+            if len(sync_books) >= RELATION_PRELOAD_THRESHOLD:
+                notion_helper.preload_date_relations()
+            sync(sync_books)
+    except WeReadAuthError as e:
+        # Cookie失效时熔断，直接结束本次同步
+        print(f"::error::{e}")
+        sys.exit(1)
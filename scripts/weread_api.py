@@ -1,12 +1,27 @@
+import asyncio
+import atexit
+import base64
 import hashlib
 from http.cookies import SimpleCookie
 import os
 import re
+import threading
+import time
+from urllib.parse import urlparse
 
+from cryptography.fernet import Fernet, InvalidToken
 import requests
 from requests.utils import cookiejar_from_dict
 from http.cookies import SimpleCookie
-from retrying import retry
+
+from retry_policy import RETRYABLE_STATUS, retry
+from state import DiskCache, load_state, save_state
+
+try:
+    # orjson解析大的响应比标准库json快一倍左右，见benchmark_json.py
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 WEREAD_URL = "https://weread.qq.com/"
 WEREAD_NOTEBOOKS_URL = "https://i.weread.qq.com/user/notebooks"
@@ -17,13 +32,108 @@ WEREAD_REVIEW_LIST_URL = "https://i.weread.qq.com/review/list"
 WEREAD_BOOK_INFO = "https://i.weread.qq.com/book/info"
 WEREAD_READDATA_DETAIL = "https://i.weread.qq.com/readdata/detail"
 WEREAD_HISTORY_URL = "https://i.weread.qq.com/readdata/summary?synckey=0"
+WEREAD_SHELF_SYNC_URL = "https://i.weread.qq.com/shelf/sync"
+# 会话登录超时的错误码
+SESSION_EXPIRED_ERRCODE = -2012
+# 预热后的会话在这段时间内视为有效，超过后下一次请求前重新预热
+SESSION_TTL = int(os.getenv("WEREAD_SESSION_TTL", 30 * 60))
+# 异步客户端对同一个host的最大并发请求数
+WEREAD_CONCURRENCY = int(os.getenv("WEREAD_CONCURRENCY", 5))
+# chapterInfos接口每次请求的书籍数量
+CHAPTER_BATCH_SIZE = int(os.getenv("WEREAD_CHAPTER_BATCH_SIZE", 20))
+# 设置后忽略本地保存的synckey，重新全量获取书架和章节
+FULL_SYNC = os.getenv("WEREAD_FULL_SYNC") in ("1", "true", "True")
+# 书架全量刷新的间隔，期间只增量获取，全量刷新用来纠正增量合并中遗漏的修改
+SHELF_FULL_SYNC_INTERVAL = int(
+    os.getenv("WEREAD_SHELF_FULL_SYNC_INTERVAL", 7 * 24 * 3600)
+)
+# 书籍详情的缓存时间，书名、作者、简介等信息基本不会变化
+BOOKINFO_CACHE_TTL = int(os.getenv("WEREAD_BOOKINFO_CACHE_TTL", 7 * 24 * 3600))
+BOOKINFO_CACHE_SIZE = int(os.getenv("WEREAD_BOOKINFO_CACHE_SIZE", 5000))
+# 书籍详情中缓存的字段，评分等会变化的字段不缓存
+BOOKINFO_CACHE_FIELDS = (
+    "bookId",
+    "title",
+    "author",
+    "isbn",
+    "intro",
+    "categories",
+    "cover",
+)
+# 设置后不使用缓存中的书籍详情
+CACHE_BYPASS = os.getenv("WEREAD_CACHE_BYPASS") in ("1", "true", "True")
+# 从CookieCloud获取的Cookie在本地加密缓存的时间
+COOKIE_CACHE_TTL = int(os.getenv("COOKIE_CACHE_TTL", 12 * 3600))
+# 连续出现这么多次登录失效后熔断，之后的请求直接失败
+AUTH_FAILURE_THRESHOLD = int(os.getenv("WEREAD_AUTH_FAILURE_THRESHOLD", 2))
+
+
+def decode_json(r):
+    """每个响应只解析一次，使用orjson时直接从bytes解析"""
+    return json_loads(r.content)
+
+
+class WeReadError(Exception):
+    """WeRead接口返回的错误，retryable表示是否值得重试"""
+
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.status_code = response.status_code if response is not None else None
+        self.errcode = None
+        if response is not None and not response.ok:
+            try:
+                self.errcode = decode_json(response).get("errcode")
+            except ValueError:
+                pass
+        if self.errcode == SESSION_EXPIRED_ERRCODE:
+            # 重新预热之后仍然登录超时，说明Cookie已经失效，重试没有意义
+            self.retryable = False
+        elif self.status_code is None or self.status_code < 400:
+            # 请求成功但是返回的数据不完整
+            self.retryable = True
+        else:
+            self.retryable = self.status_code in RETRYABLE_STATUS
+
+
+class WeReadAuthError(WeReadError):
+    """Cookie失效导致的错误，不能通过重试解决"""
+
+    def __init__(self, message, response=None):
+        super().__init__(message, response)
+        self.retryable = False
+
+
+def merge_by_key(old, new, key, removed=()):
+    """按key把增量数据合并到缓存的列表中，并去掉removed中的数据"""
+    merged = {item.get(key): item for item in old or []}
+    for item in new or []:
+        merged[item.get(key)] = item
+    for value in removed or []:
+        merged.pop(value, None)
+    return list(merged.values())
 
 
 class WeReadApi:
     def __init__(self):
+        self.cookie_from_cache = False
+        self.cookie_refreshed = False
+        self.auth_failures = 0
+        self.circuit_open = False
         self.cookie = self.get_cookie()
         self.session = requests.Session()
         self.session.cookies = self.parse_cookie_string()
+        self.warm_up_count = 0
+        self.warm_up_time = None
+        self.lock = threading.Lock()
+        self.vid = self.session.cookies.get("wr_vid", "default")
+        self.chapter_state = None
+        self.chapter_state_dirty = False
+        self.bookinfo_cache = DiskCache(
+            "bookinfo.json", BOOKINFO_CACHE_TTL, BOOKINFO_CACHE_SIZE, CACHE_BYPASS
+        )
+        atexit.register(self.report)
+        atexit.register(self.save_chapter_state)
+        atexit.register(self.bookinfo_cache.save)
 
     def try_get_cloud_cookie(self, url, id, password):
         if url.endswith("/"):
@@ -43,7 +153,7 @@ class WeReadApi:
                 result = cookie_str
         return result
 
-    def get_cookie(self):
+    def get_cookie(self, use_cache=True):
         url = os.getenv("CC_URL")
         if not url:
             url = "https://cookiecloud.malinkang.com/"
@@ -51,11 +161,47 @@ class WeReadApi:
         password = os.getenv("CC_PASSWORD")
         cookie = os.getenv("WEREAD_COOKIE")
         if url and id and password:
-            cookie = self.try_get_cloud_cookie(url, id, password)
+            cookie = self.load_cached_cookie(id, password) if use_cache else None
+            self.cookie_from_cache = cookie is not None
+            if cookie is None:
+                cookie = self.try_get_cloud_cookie(url, id, password)
+                if cookie:
+                    self.save_cached_cookie(id, password, cookie)
         if not cookie or not cookie.strip():
             raise Exception("没有找到cookie，请按照文档填写cookie")
         return cookie
 
+    def get_cookie_cipher(self, id, password):
+        """用CookieCloud的密码派生加密本地缓存的密钥"""
+        key = hashlib.pbkdf2_hmac("sha256", password.encode(), id.encode(), 100000)
+        return Fernet(base64.urlsafe_b64encode(key))
+
+    def load_cached_cookie(self, id, password):
+        """读取本地缓存的Cookie，不存在、过期或者无法解密时返回None"""
+        token = load_state("cookie.json").get("token")
+        if not token:
+            return None
+        try:
+            cipher = self.get_cookie_cipher(id, password)
+            return cipher.decrypt(token.encode(), ttl=COOKIE_CACHE_TTL).decode()
+        except InvalidToken:
+            return None
+
+    def save_cached_cookie(self, id, password, cookie):
+        token = self.get_cookie_cipher(id, password).encrypt(cookie.encode())
+        save_state("cookie.json", {"token": token.decode()})
+
+    def refresh_cookie(self):
+        """缓存的Cookie被WeRead拒绝时，从CookieCloud重新获取一次"""
+        with self.lock:
+            if self.cookie_from_cache:
+                print("缓存的Cookie已失效，重新从CookieCloud获取")
+                self.cookie = self.get_cookie(use_cache=False)
+                self.session.cookies = self.parse_cookie_string()
+                self.cookie_refreshed = True
+                self.warm_up()
+            return self.cookie_refreshed
+
     def parse_cookie_string(self):
         cookie = SimpleCookie()
         cookie.load(self.cookie)
@@ -68,54 +214,161 @@ class WeReadApi:
             )
         return cookiejar
 
-    def get_bookshelf(self):
+    def warm_up(self):
+        """访问首页刷新会话Cookie"""
         self.session.get(WEREAD_URL)
-        r = self.session.get(
-            "https://i.weread.qq.com/shelf/sync?synckey=0&teenmode=0&album=1&onlyBookid=0"
-        )
+        self.warm_up_count += 1
+        self.warm_up_time = time.time()
+
+    def ensure_session(self):
+        """会话未预热或者已经过期时才重新预热"""
+        with self.lock:
+            if (
+                self.warm_up_time is None
+                or time.time() - self.warm_up_time > SESSION_TTL
+            ):
+                self.warm_up()
+
+    def is_session_expired(self, r):
         if r.ok:
-            return r.json()
+            return False
+        try:
+            return decode_json(r).get("errcode") == SESSION_EXPIRED_ERRCODE
+        except ValueError:
+            return False
+
+    def request(self, method, url, **kwargs):
+        """发送请求，接口返回登录超时时重新预热会话后再试一次"""
+        if self.circuit_open:
+            raise WeReadAuthError("WeRead登录已失效，已停止后续请求，请更新Cookie")
+        self.ensure_session()
+        warm_up_time = self.warm_up_time
+        r = self.session.request(method, url, **kwargs)
+        if self.is_session_expired(r):
+            with self.lock:
+                # 并发请求同时过期时只需要其中一个重新预热
+                if self.warm_up_time == warm_up_time:
+                    self.warm_up()
+            r = self.session.request(method, url, **kwargs)
+            if self.is_session_expired(r) and self.refresh_cookie():
+                r = self.session.request(method, url, **kwargs)
+            if self.is_session_expired(r):
+                self.record_auth_failure()
+                raise WeReadAuthError(f"WeRead登录已失效，请更新Cookie {r.text}", r)
+        self.auth_failures = 0
+        return r
+
+    def record_auth_failure(self):
+        with self.lock:
+            self.auth_failures += 1
+            if self.auth_failures >= AUTH_FAILURE_THRESHOLD and not self.circuit_open:
+                self.circuit_open = True
+                print(f"WeRead连续{self.auth_failures}次登录失效，后续请求将直接失败")
+
+    def report(self):
+        print(f"WeRead会话预热次数：{self.warm_up_count}")
+        print(
+            f"书籍详情缓存命中{self.bookinfo_cache.hits}次，"
+            f"未命中{self.bookinfo_cache.misses}次"
+        )
+
+    def get_bookshelf(self):
+        """获取书架，使用上次保存的synckey只拉取增量，再合并到本地快照
+
+        每隔SHELF_FULL_SYNC_INTERVAL使用synckey=0全量获取一次，替换本地快照
+        """
+        state_name = f"shelf_{self.vid}.json"
+        state = {} if FULL_SYNC else load_state(state_name)
+        snapshot = state.get("snapshot")
+        full_sync_at = state.get("full_sync_at", 0)
+        synckey = 0
+        if snapshot and time.time() - full_sync_at < SHELF_FULL_SYNC_INTERVAL:
+            synckey = state.get("synckey", 0)
+        params = dict(synckey=synckey, teenmode=0, album=1, onlyBookid=0)
+        r = self.request("GET", WEREAD_SHELF_SYNC_URL, params=params)
+        if not r.ok:
+            raise WeReadError(f"Could not get bookshelf {r.text}", r)
+        data = decode_json(r)
+        if synckey:
+            data = self.merge_bookshelf(snapshot, data)
         else:
-            raise Exception(f"Could not get bookshelf {r.text}")
+            full_sync_at = time.time()
+        save_state(
+            state_name,
+            {
+                "synckey": data.get("synckey", synckey),
+                "full_sync_at": full_sync_at,
+                "snapshot": data,
+            },
+        )
+        return data
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    def merge_bookshelf(self, snapshot, delta):
+        removed = delta.get("removed", [])
+        shelf = {**snapshot, **delta}
+        shelf["books"] = merge_by_key(
+            snapshot.get("books"), delta.get("books"), "bookId", removed
+        )
+        shelf["bookProgress"] = merge_by_key(
+            snapshot.get("bookProgress"), delta.get("bookProgress"), "bookId", removed
+        )
+        shelf["archive"] = merge_by_key(
+            snapshot.get("archive"),
+            delta.get("archive"),
+            "archiveId",
+            delta.get("removedArchive"),
+        )
+        return shelf
+
+    @retry()
     def get_notebooklist(self):
         """获取笔记本列表"""
-        self.session.get(WEREAD_URL)
-        r = self.session.get(WEREAD_NOTEBOOKS_URL)
+        r = self.request("GET", WEREAD_NOTEBOOKS_URL)
         if r.ok:
-            data = r.json()
-            books = data.get("books")
+            books = decode_json(r).get("books")
             books.sort(key=lambda x: x["sort"])
             return books
         else:
-            raise Exception(f"Could not get notebook list {r.text}")
+            raise WeReadError(f"Could not get notebook list {r.text}", r)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def get_bookinfo(self, bookId):
-        """获取书的详情"""
-        self.session.get(WEREAD_URL)
+    def get_bookinfo(self, bookId, fresh=False):
+        """获取书的详情，优先使用本地缓存
+
+        缓存中只有BOOKINFO_CACHE_FIELDS中不会变化的字段，评分等会变化的字段
+        只有请求时才有，需要这些字段时fresh传True
+        """
+        if not fresh:
+            bookInfo = self.bookinfo_cache.get(bookId)
+            if bookInfo is not None:
+                return {k: v for k, v in bookInfo.items() if k in BOOKINFO_CACHE_FIELDS}
+        bookInfo = self.fetch_bookinfo(bookId)
+        if bookInfo is not None:
+            self.bookinfo_cache.set(
+                bookId,
+                {k: v for k, v in bookInfo.items() if k in BOOKINFO_CACHE_FIELDS},
+            )
+        return bookInfo
+
+    @retry()
+    def fetch_bookinfo(self, bookId):
         params = dict(bookId=bookId)
-        r = self.session.get(WEREAD_BOOK_INFO, params=params)
+        r = self.request("GET", WEREAD_BOOK_INFO, params=params)
         if r.ok:
-            return r.json()
+            return decode_json(r)
         else:
             return None
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @retry()
     def get_bookmark_list(self, bookId):
-        self.session.get(WEREAD_URL)
         params = dict(bookId=bookId)
-        r = self.session.get(WEREAD_BOOKMARKLIST_URL, params=params)
+        r = self.request("GET", WEREAD_BOOKMARKLIST_URL, params=params)
         if r.ok:
-            bookmarks = r.json().get("updated")
-            return bookmarks
+            return decode_json(r).get("updated")
         else:
-            raise Exception(f"Could not get {bookId} bookmark list")
+            raise WeReadError(f"Could not get {bookId} bookmark list", r)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @retry()
     def get_read_info(self, bookId):
-        self.session.get(WEREAD_URL)
         params = dict(
             noteCount=1,
             readingDetail=1,
@@ -133,64 +386,149 @@ class WeReadApi:
             "osver":"12",
             "User-Agent": "WeRead/8.2.5 WRBrand/xiaomi Dalvik/2.1.0 (Linux; U; Android 12; Redmi Note 7 Pro Build/SQ3A.220705.004)",
         }
-        r = self.session.get(WEREAD_READ_INFO_URL,headers=headers, params=params)
+        r = self.request(
+            "GET", WEREAD_READ_INFO_URL, headers=headers, params=params
+        )
         if r.ok:
-            return r.json()
+            return decode_json(r)
         else:
-            raise Exception(f"get {bookId} read info failed {r.text}")
+            raise WeReadError(f"get {bookId} read info failed {r.text}", r)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @retry()
     def get_review_list(self, bookId):
-        self.session.get(WEREAD_URL)
         params = dict(bookId=bookId, listType=11, mine=1, syncKey=0)
-        r = self.session.get(WEREAD_REVIEW_LIST_URL, params=params)
+        r = self.request("GET", WEREAD_REVIEW_LIST_URL, params=params)
         if r.ok:
-            reviews = r.json().get("reviews")
-            reviews = list(map(lambda x: x.get("review"), reviews))
-            reviews = [
-                {"chapterUid": 1000000, **x} if x.get("type") == 4 else x
-                for x in reviews
-            ]
+            reviews = []
+            for item in decode_json(r).get("reviews"):
+                review = item.get("review")
+                # 点评没有章节，统一放到虚拟的点评章节中
+                if review.get("type") == 4:
+                    review.setdefault("chapterUid", 1000000)
+                reviews.append(review)
             return reviews
         else:
-            raise Exception(f"get {bookId} review list failed {r.text}")
+            raise WeReadError(f"get {bookId} review list failed {r.text}", r)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @retry()
     def get_api_data(self):
-        r = self.session.get(WEREAD_HISTORY_URL)
+        r = self.request("GET", WEREAD_HISTORY_URL)
         if not r.ok:
-            if r.json()["errcode"] == -2012:
-                self.session.get(WEREAD_URL)
-                r = self.session.get(WEREAD_HISTORY_URL)
-            else:
-                raise Exception("Can not get weread history data")
-        return r.json()
-
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+            raise WeReadError("Can not get weread history data", r)
+        return decode_json(r)
+
     def get_chapter_info(self, bookId):
-        self.session.get(WEREAD_URL)
-        body = {"bookIds": [bookId], "synckeys": [0], "teenmode": 0}
-        r = self.session.post(WEREAD_CHAPTER_INFO, json=body)
-        if (
-            r.ok
-            and "data" in r.json()
-            and len(r.json()["data"]) == 1
-            and "updated" in r.json()["data"][0]
-        ):
-            update = r.json()["data"][0]["updated"]
-            update.append(
-                {
-                    "chapterUid": 1000000,
-                    "chapterIdx": 1000000,
-                    "updateTime": 1683825006,
-                    "readAhead": 0,
-                    "title": "点评",
-                    "level": 1,
-                }
+        return self.get_chapter_infos([bookId]).get(bookId)
+
+    def post_chapter_infos(self, bookIds, synckeys):
+        body = {"bookIds": bookIds, "synckeys": synckeys, "teenmode": 0}
+        r = self.request("POST", WEREAD_CHAPTER_INFO, json=body)
+        data = decode_json(r).get("data") if r.ok else None
+        if data is None:
+            raise WeReadError(f"get {bookIds} chapter info failed {r.text}", r)
+        return data
+
+    @retry()
+    def fetch_chapter_batch(self, bookIds, synckeys):
+        return self.post_chapter_infos(bookIds, synckeys)
+
+    @retry()
+    def fetch_chapter_info(self, bookId, synckey):
+        """单独请求一本书的章节信息，只有一本书时返回结果和请求一一对应"""
+        data = self.post_chapter_infos([bookId], [synckey])
+        if len(data) != 1 or (synckey == 0 and "updated" not in data[0]):
+            raise WeReadError(f"get {bookId} chapter info failed {data}")
+        return data[0]
+
+    def get_chapter_infos(self, bookIds):
+        """一次请求获取多本书的章节信息，返回bookId到章节字典的映射
+
+        请求时带上每本书上次的synckey，只获取变化的章节并合并到本地快照，
+        返回结果按bookId对应，批量请求中缺失或者不完整的书再单独请求
+        """
+        with self.lock:
+            chapter_state = self.get_chapter_state()
+            cached = {bookId: chapter_state.get(bookId) for bookId in bookIds}
+        synckeys = {
+            bookId: cached.get(bookId).get("synckey", 0) if cached.get(bookId) else 0
+            for bookId in bookIds
+        }
+        items = {}
+        if len(bookIds) > 1:
+            try:
+                data = self.fetch_chapter_batch(
+                    bookIds, [synckeys.get(bookId) for bookId in bookIds]
+                )
+            except WeReadAuthError:
+                raise
+            except WeReadError as e:
+                print(f"批量获取章节信息失败，改为逐本获取：{e}")
+                data = []
+            for item in data:
+                bookId = item.get("bookId")
+                if bookId not in synckeys:
+                    continue
+                if synckeys.get(bookId) == 0 and "updated" not in item:
+                    continue
+                items[bookId] = item
+        result = {}
+        states = {}
+        for bookId in bookIds:
+            synckey = synckeys.get(bookId)
+            item = items.get(bookId)
+            if item is None:
+                item = self.fetch_chapter_info(bookId, synckey)
+            chapters = item.get("updated", [])
+            if synckey:
+                chapters = merge_by_key(
+                    cached.get(bookId).get("chapters"),
+                    chapters,
+                    "chapterUid",
+                    item.get("removed"),
+                )
+            states[bookId] = {
+                "synckey": item.get("synckey", synckey),
+                "chapters": chapters,
+            }
+            # 返回副本，避免调用方修改章节时改到本地快照
+            result[bookId] = self.parse_chapter_info([dict(x) for x in chapters])
+        with self.lock:
+            self.get_chapter_state().update(states)
+            self.chapter_state_dirty = True
+        return result
+
+    def get_cached_chapter_info(self, bookId):
+        """不请求微信读书，返回本地快照中的章节信息，没有时返回None"""
+        with self.lock:
+            state = self.get_chapter_state().get(bookId)
+        if not state:
+            return None
+        return self.parse_chapter_info([dict(x) for x in state.get("chapters")])
+
+    def get_chapter_state(self):
+        if self.chapter_state is None:
+            self.chapter_state = (
+                {} if FULL_SYNC else load_state(f"chapters_{self.vid}.json")
             )
-            return {item["chapterUid"]: item for item in update}
-        else:
-            raise Exception(f"get {bookId} chapter info failed {r.text}")
+        return self.chapter_state
+
+    def save_chapter_state(self):
+        if self.chapter_state_dirty:
+            save_state(f"chapters_{self.vid}.json", self.chapter_state)
+            self.chapter_state_dirty = False
+
+    def parse_chapter_info(self, update):
+        update.append(
+            {
+                "chapterUid": 1000000,
+                "chapterIdx": 1000000,
+                "updateTime": 1683825006,
+                "readAhead": 0,
+                "title": "点评",
+                "level": 1,
+            }
+        )
+        return {item["chapterUid"]: item for item in update}
 
     def transform_id(self, book_id):
         id_length = len(book_id)
@@ -233,3 +571,71 @@ class WeReadApi:
 
     def get_url(self, book_id):
         return f"https://weread.qq.com/web/reader/{self.calculate_book_str_id(book_id)}"
+
+
+class AsyncWeReadApi:
+    """WeReadApi的异步版本，请求在线程中执行，同一个host的并发数不超过concurrency"""
+
+    def __init__(self, weread_api=None, concurrency=WEREAD_CONCURRENCY):
+        self.weread_api = weread_api if weread_api is not None else WeReadApi()
+        self.concurrency = concurrency
+        self.semaphores = {}
+
+    async def call(self, url, func, *args):
+        host = urlparse(url).netloc
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.concurrency)
+        async with self.semaphores[host]:
+            return await asyncio.to_thread(func, *args)
+
+    async def get_bookinfo(self, bookId, fresh=False):
+        return await self.call(
+            WEREAD_BOOK_INFO, self.weread_api.get_bookinfo, bookId, fresh
+        )
+
+    async def get_read_info(self, bookId):
+        return await self.call(
+            WEREAD_READ_INFO_URL, self.weread_api.get_read_info, bookId
+        )
+
+    async def get_bookmark_list(self, bookId):
+        return await self.call(
+            WEREAD_BOOKMARKLIST_URL, self.weread_api.get_bookmark_list, bookId
+        )
+
+    async def get_review_list(self, bookId):
+        return await self.call(
+            WEREAD_REVIEW_LIST_URL, self.weread_api.get_review_list, bookId
+        )
+
+    async def get_chapter_info(self, bookId):
+        return await self.call(
+            WEREAD_CHAPTER_INFO, self.weread_api.get_chapter_info, bookId
+        )
+
+    async def get_chapter_infos(self, bookIds):
+        """按CHAPTER_BATCH_SIZE分批并发获取章节信息"""
+        batches = [
+            bookIds[i : i + CHAPTER_BATCH_SIZE]
+            for i in range(0, len(bookIds), CHAPTER_BATCH_SIZE)
+        ]
+        results = await asyncio.gather(
+            *[
+                self.call(WEREAD_CHAPTER_INFO, self.weread_api.get_chapter_infos, batch)
+                for batch in batches
+            ]
+        )
+        chapter_infos = {}
+        for result in results:
+            chapter_infos.update(result)
+        return chapter_infos
+
+    async def gather(self, func, bookIds, return_exceptions=False):
+        """对多本书并发调用func，返回bookId到结果的字典
+
+        return_exceptions为True时单本书失败不影响其他书，结果中是对应的异常
+        """
+        results = await asyncio.gather(
+            *[func(bookId) for bookId in bookIds], return_exceptions=return_exceptions
+        )
+        return dict(zip(bookIds, results))